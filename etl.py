@@ -2,6 +2,7 @@ from datetime import timedelta
 import petl as etl
 import math
 from fhir_petl.fhir import to_json
+from fhir_petl.index import subjectindex
 from fhir_petl.util import resolve, mkdirp, number, year, dateparser, ISOFormat
 from datetime import datetime
 
@@ -132,7 +133,7 @@ patients = etl.io.csv.fromcsv(resolve("work/Patient_ktb_updated.csv")).fieldmap(
     True,
 )
 
-index = patients.cut("SID", "id").rename("id", "subject")
+index = subjectindex(patients, "SID")
 
 
 def proc_code(rec):
@@ -151,7 +152,7 @@ def proc_code(rec):
 
 
 # procedures = (etl.io.csv.fromcsv(resolve('work/Procedure.csv'))
-#               .hashjoin(index, lkey='SID', rkey='SID')
+#               .subjectjoin(index, 'SID')
 #               .fieldmap({
 #                   'id': 'ID',
 #                   'date': lambda rec: date(rec['PROC_DATE'] or rec['ARRIVE_DATE'] or rec['DISCHARGE_DATE']),
@@ -231,7 +232,7 @@ def cv_value(rec):
 
 observations = (
     etl.io.csv.fromcsv(resolve("work/Observation_bmi_gs.csv"), encoding="utf-8-sig")
-    .hashjoin(index, lkey="SID", rkey="SID")
+    .subjectjoin(index, "SID")
     .fieldmap(
         {
             "id": "ID",
@@ -249,7 +250,7 @@ observations = (
 
 # observations = (
 #     etl.io.csv.fromcsv(resolve("work/Observation_ktb2.csv"), encoding="utf-8-sig")
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -267,7 +268,7 @@ observations = (
 
 # observations = (
 #     etl.io.csv.fromcsv(resolve("work/Observation_ktb2.csv"), encoding="utf-8-sig")
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -290,7 +291,7 @@ observations = (
 
 # observations = (
 #     etl.io.csv.fromcsv(resolve("work/ktb_Obs_valueQuantity.csv"), encoding="utf-8-sig")
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -308,7 +309,7 @@ observations = (
 
 # observations = (
 #     etl.io.csv.fromcsv(resolve("work/ktb_Obs_vcc.csv"), encoding="utf-8-sig")
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -375,7 +376,7 @@ def map_stage(stage):
 
 # conditions = (
 #     etl.io.csv.fromcsv(resolve("work/Condition_ktb.csv"))
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -392,7 +393,7 @@ def map_stage(stage):
 # )
 
 # med_requests = (etl.io.csv.fromcsv(resolve('work/MedicationRequest.csv'))
-#                 .hashjoin(index, lkey='SID', rkey='SID')
+#                 .subjectjoin(index, 'SID')
 #                 .fieldmap({
 #                     'id': 'ID',
 #                     'date': ('ORDER_DATE', date),
@@ -468,7 +469,7 @@ def map_indication(indication):
 #     etl.io.csv.fromcsv(
 #         resolve("work/MedicationStatement_ktb.csv"), encoding="utf-8-sig"
 #     )
-#     .hashjoin(index, lkey="SID", rkey="SID")
+#     .subjectjoin(index, "SID")
 #     .fieldmap(
 #         {
 #             "id": "ID",
@@ -501,7 +502,12 @@ def map_indication(indication):
 mkdirp(resolve("fhir"))
 # to_json(patients, "Patient", resolve("fhir/Patient_ktb_updated.json"))
 # to_json(procedures, 'Procedure', resolve('fhir/Procedure.json'))
-to_json(observations, "Observation", resolve("fhir/Observation_bmi_gs.json"))
+to_json(
+    observations,
+    "Observation",
+    resolve("fhir/Observation_bmi_gs.json"),
+    checkpoint=resolve("fhir/Observation_bmi_gs.checkpoint.json"),
+)
 # to_json(conditions, "Condition", resolve("fhir/Condition_ktb.json"))
 # to_json(med_requests, 'MedicationRequest', resolve('fhir/MedicationRequest.json'))
 # to_json(
@@ -1,6 +1,6 @@
-from datetime import timedelta
 import petl as etl
 from fhir_petl.fhir import to_json
+from fhir_petl.index import subjectindex
 from fhir_petl.util import resolve, mkdirp, number, join, year, dateparser, ISOFormat
 
 def map_race(race):
@@ -25,35 +25,36 @@ patients = (etl.io.csv.fromcsv(resolve('work/Patient.csv'))
                 'tag': lambda rec: ('subject-type', 'case')
             }, True))
 
-index = (patients
-         .cut('STUDYID', 'id', 'index_date')
-         .rename('id', 'subject'))
+index = subjectindex(patients, 'STUDYID', fields=['index_date'])
 
 procedures = (etl.io.csv.fromcsv(resolve('work/Procedure.csv'))
-              .hashjoin(index, lkey='STUDYID', rkey='STUDYID')
+              .subjectjoin(index, 'STUDYID')
+              .shiftdates('date', 'index_date', 'DAYS_VIS_INDEX')
               .fieldmap({
                   'id': 'ID',
-                  'date': lambda rec: rec['index_date'] + timedelta(int(rec['DAYS_VIS_INDEX'])),
+                  'date': 'date',
                   'code': lambda rec: ('http://www.ama-assn.org/go/cpt', rec['PROC_CODE'], rec['NAME'].strip('" ')),
                   'subject': 'subject'
               }, True))
 
 conditions = (etl.io.csv.fromcsv(resolve('work/Condition.csv'))
-              .hashjoin(index, lkey='STUDYID', rkey='STUDYID')
+              .subjectjoin(index, 'STUDYID')
+              .shiftdates('onset', 'index_date', 'DAYS_ADM_INDEX')
               .select('DX_CODE', lambda x: x)
               .fieldmap({
                   'id': 'ID',
-                  'onset': lambda rec: rec['index_date'] + timedelta(int(rec['DAYS_ADM_INDEX'])),
+                  'onset': 'onset',
                   'code': lambda rec: ('http://hl7.org/fhir/sid/icd-9-cm', rec['DX_CODE']),
                   'note': lambda rec: join(rec['CARE_SETTING_TEXT'], rec['LOCATION_POINT_OF_CARE']),
                   'subject': 'subject'
               }, True))
 
 observations = (etl.io.csv.fromcsv(resolve('work/Observation.csv'))
-                .hashjoin(index, lkey='STUDYID', rkey='STUDYID')
+                .subjectjoin(index, 'STUDYID')
+                .shiftdates('date', 'index_date', 'DAYS_VIS_INDEX')
                 .fieldmap({
                     'id': 'ID',
-                    'date': lambda rec: rec['index_date'] + timedelta(int(rec['DAYS_VIS_INDEX'])),
+                    'date': 'date',
                     'code': lambda rec: ('lab-text', rec['NAME'], rec['NAME']),
                     'value': lambda rec: number(rec['RESULT_VALUE']) if rec['RESULT_VALUE'] else (rec['CODED_NAME'] or None),
                     'subject': 'subject'
@@ -71,10 +72,11 @@ def medications(rec):
     ]
 
 med_dispenses = (etl.io.csv.fromcsv(resolve('work/MedicationDispense.csv'))
-                 .hashjoin(index, lkey='CASE_ID', rkey='STUDYID')
+                 .subjectjoin(index, 'CASE_ID')
+                 .shiftdates('date', 'index_date', 'DAYS_VIS_INDEX')
                  .fieldmap({
                      'id': 'ID',
-                     'date': lambda rec: rec['index_date'] + timedelta(int(rec['DAYS_VIS_INDEX'])),
+                     'date': 'date',
                      'medication': medications,
                      'quantity': ('DISPENSE_AMOUNT', number),
                      'daysSupply': ('NUMBER_OF_DAYS_SUPPLY', number),
@@ -92,10 +94,11 @@ def medications2(rec):
     ]
 
 med_requests = (etl.io.csv.fromcsv(resolve('work/MedicationRequest.csv'))
-                .hashjoin(index, lkey='STUDYID', rkey='STUDYID')
+                .subjectjoin(index, 'STUDYID')
+                .shiftdates('date', 'index_date', 'DAYS_ORDER_INDEX')
                 .fieldmap({
                     'id': 'ID',
-                    'date': lambda rec: rec['index_date'] + timedelta(int(rec['DAYS_ORDER_INDEX'])),
+                    'date': 'date',
                     'medication': medications2,
                     'subject': 'subject'
                 }, True))
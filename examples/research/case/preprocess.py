@@ -1,38 +1,26 @@
 import petl as etl
-from fhir_petl.util import preprocess, resolve, mkdirp
+from fhir_petl.batch import Job, run_batch
+from fhir_petl.util import resolve, mkdirp
 import random
 
-mkdirp(resolve('work'))
-
-selection = etl.io.csv.fromtsv(resolve('sa1cases.txt')).columns()['STUDYID']
-selection = set(random.sample(selection, 1000))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('case_demog_27065.csv')).selectin('STUDYID', selection),
-    'STUDYID'
-).tocsv(resolve('work/Patient.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('dx_case_inst.txt')).selectin('STUDYID', selection),
-    'STUDYID',
-).tocsv(resolve('work/Condition.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('lab_case_inst.txt')).selectin('STUDYID', selection),
-    'STUDYID'
-).tocsv(resolve('work/Observation.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('med_case_inst_gpi.txt')).selectin('CASE_ID', selection),
-    'CASE_ID'
-).tocsv(resolve('work/MedicationDispense.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('order_case_inst_gpi.txt')).selectin('STUDYID', selection),
-    'STUDYID'
-).tocsv(resolve('work/MedicationRequest.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('proc_case_inst.txt')).selectin('STUDYID', selection),
-    'STUDYID'
-).tocsv(resolve('work/Procedure.csv'))
+# the jobs run in worker processes, which import this module
+if __name__ == '__main__':
+    mkdirp(resolve('work'))
+
+    selection = etl.io.csv.fromtsv(resolve('sa1cases.txt')).columns()['STUDYID']
+    selection = set(random.sample(selection, 1000))
+
+    run_batch([
+        Job(resolve('case_demog_27065.csv'), resolve('work/Patient.csv'),
+            'STUDYID', filter=('STUDYID', selection)),
+        Job(resolve('dx_case_inst.txt'), resolve('work/Condition.csv'),
+            'STUDYID', filter=('STUDYID', selection)),
+        Job(resolve('lab_case_inst.txt'), resolve('work/Observation.csv'),
+            'STUDYID', filter=('STUDYID', selection)),
+        Job(resolve('med_case_inst_gpi.txt'), resolve('work/MedicationDispense.csv'),
+            'CASE_ID', filter=('CASE_ID', selection)),
+        Job(resolve('order_case_inst_gpi.txt'), resolve('work/MedicationRequest.csv'),
+            'STUDYID', filter=('STUDYID', selection)),
+        Job(resolve('proc_case_inst.txt'), resolve('work/Procedure.csv'),
+            'STUDYID', filter=('STUDYID', selection)),
+    ])
@@ -1,38 +1,26 @@
 import petl as etl
-from fhir_petl.util import preprocess, resolve, mkdirp
+from fhir_petl.batch import Job, run_batch
+from fhir_petl.util import resolve, mkdirp
 import random
 
-mkdirp(resolve('work'))
-
-selection = etl.io.csv.fromtsv(resolve('sa1controls.txt')).columns()['control_id']
-selection = set(random.sample(selection, 1000))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('controls.txt')).selectin('control_id', selection),
-    'control_id'
-).tocsv(resolve('work/Patient.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('dx_control_inst.txt')).selectin('CONTROL_ID', selection),
-    'CONTROL_ID',
-).tocsv(resolve('work/Condition.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('lab_control_inst.txt')).selectin('CONTROL_ID', selection),
-    'CONTROL_ID'
-).tocsv(resolve('work/Observation.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('med_control_inst_gpi.txt')).selectin('CONTROL_ID', selection),
-    'CONTROL_ID'
-).tocsv(resolve('work/MedicationDispense.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('order_control_inst_gpi.txt')).selectin('CONTROL_ID', selection),
-    'CONTROL_ID'
-).tocsv(resolve('work/MedicationRequest.csv'))
-
-preprocess(
-    etl.io.csv.fromtsv(resolve('proc_control_inst.txt')).selectin('CONTROL_ID', selection),
-    'CONTROL_ID'
-).tocsv(resolve('work/Procedure.csv'))
+# the jobs run in worker processes, which import this module
+if __name__ == '__main__':
+    mkdirp(resolve('work'))
+
+    selection = etl.io.csv.fromtsv(resolve('sa1controls.txt')).columns()['control_id']
+    selection = set(random.sample(selection, 1000))
+
+    run_batch([
+        Job(resolve('controls.txt'), resolve('work/Patient.csv'),
+            'control_id', filter=('control_id', selection)),
+        Job(resolve('dx_control_inst.txt'), resolve('work/Condition.csv'),
+            'CONTROL_ID', filter=('CONTROL_ID', selection)),
+        Job(resolve('lab_control_inst.txt'), resolve('work/Observation.csv'),
+            'CONTROL_ID', filter=('CONTROL_ID', selection)),
+        Job(resolve('med_control_inst_gpi.txt'), resolve('work/MedicationDispense.csv'),
+            'CONTROL_ID', filter=('CONTROL_ID', selection)),
+        Job(resolve('order_control_inst_gpi.txt'), resolve('work/MedicationRequest.csv'),
+            'CONTROL_ID', filter=('CONTROL_ID', selection)),
+        Job(resolve('proc_control_inst.txt'), resolve('work/Procedure.csv'),
+            'CONTROL_ID', filter=('CONTROL_ID', selection)),
+    ])
@@ -1,6 +1,7 @@
 from datetime import timedelta
 import petl as etl
 from fhir_petl.fhir import to_json
+from fhir_petl.index import subjectindex
 from fhir_petl.util import resolve, mkdirp, number, year, dateparser, ISOFormat
 
 date = dateparser('%Y-%m-%d %H:%M:%S', ISOFormat.DAY)
@@ -35,9 +36,7 @@ patients = (etl.io.csv.fromcsv(resolve('work/Patient.csv'))
                 'tag': ('Cohort', lambda cohort: ('cohort', cohort.upper()))
             }, True))
 
-index = (patients
-         .cut('SID', 'id', 'sample_date')
-         .rename('id', 'subject'))
+index = subjectindex(patients, 'SID', fields=['sample_date'])
 
 def proc_code(rec):
     if rec['PROC_SYS_ID'] == 1:
@@ -46,7 +45,7 @@ def proc_code(rec):
     return ('http://hl7.org/fhir/sid/icd-9-cm', rec['PROC_CODE'], rec['PROC_NAME'].strip('" '))
 
 procedures = (etl.io.csv.fromcsv(resolve('work/Procedure.csv'))
-              .hashjoin(index, lkey='SID', rkey='SID')
+              .subjectjoin(index, 'SID')
               .fieldmap({
                   'id': 'ID',
                   'date': lambda rec: date(rec['PROC_DATE'] or rec['ARRIVE_DATE'] or rec['DISCHARGE_DATE']),
@@ -70,7 +69,7 @@ def cv_value(rec):
     return rec['CV_RESULT_CATEGORICAL'] or None
 
 observations = (etl.io.csv.fromcsv(resolve('work/Observation.csv'))
-                .hashjoin(index, lkey='SID', rkey='SID')
+                .subjectjoin(index, 'SID')
                 .fieldmap({
                     'id': 'ID',
                     'date': lambda rec: rec['sample_date'] + timedelta(int(rec['Date_VIS_Sample'])),
@@ -87,7 +86,7 @@ def dx_code(rec):
     return ('http://hl7.org/fhir/sid/icd-10', rec['DX_CODE'], rec['DX_NAME'])
 
 conditions = (etl.io.csv.fromcsv(resolve('work/Condition.csv'))
-              .hashjoin(index, lkey='SID', rkey='SID')
+              .subjectjoin(index, 'SID')
               .fieldmap({
                   'id': 'ID',
                   'onset': ('DATE_OF_DX', date),
@@ -96,7 +95,7 @@ conditions = (etl.io.csv.fromcsv(resolve('work/Condition.csv'))
               }, True))
 
 med_requests = (etl.io.csv.fromcsv(resolve('work/MedicationRequest.csv'))
-                .hashjoin(index, lkey='SID', rkey='SID')
+                .subjectjoin(index, 'SID')
                 .fieldmap({
                     'id': 'ID',
                     'date': ('ORDER_DATE', date),
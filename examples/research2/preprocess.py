@@ -1,24 +1,14 @@
-import petl as etl
-from fhir_petl.util import preprocess, resolve, mkdirp
-
-mkdirp(resolve('work'))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('Table_1_Demographics_New_Cohorts.csv'))
-).tocsv(resolve('work/Patient.csv'))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('Diagnoses.csv'))
-).tocsv(resolve('work/Condition.csv'))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('fairbanks_cv.dedup.csv'))
-).tocsv(resolve('work/Observation.csv'))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('Prescriptions.csv'))
-).tocsv(resolve('work/MedicationRequest.csv'))
-
-preprocess(
-    etl.io.csv.fromcsv(resolve('Procedures.csv'))
-).tocsv(resolve('work/Procedure.csv'))
+from fhir_petl.batch import Job, run_batch
+from fhir_petl.util import resolve, mkdirp
+
+# the jobs run in worker processes, which import this module
+if __name__ == '__main__':
+    mkdirp(resolve('work'))
+
+    run_batch([
+        Job(resolve('Table_1_Demographics_New_Cohorts.csv'), resolve('work/Patient.csv')),
+        Job(resolve('Diagnoses.csv'), resolve('work/Condition.csv')),
+        Job(resolve('fairbanks_cv.dedup.csv'), resolve('work/Observation.csv')),
+        Job(resolve('Prescriptions.csv'), resolve('work/MedicationRequest.csv')),
+        Job(resolve('Procedures.csv'), resolve('work/Procedure.csv')),
+    ])
@@ -0,0 +1,339 @@
+from petl.util.base import Table
+from fhir_petl.fhir import resources
+from fhir_petl.io import compile_path, get_path
+from fhir_petl.util import chunks
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = ds = pq = None
+
+
+# read a Parquet file (or a directory of them) as a table.
+# only the given columns are read, and the cut, selectin
+# and selecteq of the table are pushed down into the scan:
+# they narrow the columns and skip the row groups whose
+# statistics can't match instead of filtering rows in
+# Python. values keep their Arrow types, so a selection
+# on an integer column needs integer values
+def from_parquet(source, columns=None, filter=None, batch_size=65536):
+    return ArrowView(source, "parquet", columns, filter, batch_size)
+
+
+# read an Arrow IPC (Feather v2) file as a table, like
+# from_parquet
+def from_arrow(source, columns=None, filter=None, batch_size=65536):
+    return ArrowView(source, "ipc", columns, filter, batch_size)
+
+
+class ArrowView(Table):
+    def __init__(self, source, format, columns=None, filter=None, batch_size=65536):
+        if ds is None:
+            raise ImportError("Parquet and Arrow sources require the pyarrow package")
+        self.source = source
+        self.format = format
+        self.columns = tuple(columns) if columns is not None else None
+        self.filter = filter
+        self.batch_size = batch_size
+
+    def copy(self, columns=None, filter=None):
+        if columns is None:
+            columns = self.columns
+        if filter is not None and self.filter is not None:
+            filter = self.filter & filter
+        elif filter is None:
+            filter = self.filter
+        return ArrowView(self.source, self.format, columns, filter, self.batch_size)
+
+    def __iter__(self):
+        dataset = ds.dataset(self.source, format=self.format)
+        columns = self.columns
+        if columns is None:
+            columns = tuple(dataset.schema.names)
+        yield columns
+        scanner = dataset.scanner(
+            columns=list(columns), filter=self.filter, batch_size=self.batch_size
+        )
+        for batch in scanner.to_batches():
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    def cut(self, *args, **kwargs):
+        if kwargs or not all(isinstance(field, str) for field in args):
+            return super().cut(*args, **kwargs)
+        if self.columns is not None and not set(args) <= set(self.columns):
+            return super().cut(*args)
+        return self.copy(columns=args)
+
+    # only fields of the table are pushed down, so selecting
+    # on a field that was cut fails like it does in petl
+    def pushdown(self, field, complement):
+        if complement or not isinstance(field, str):
+            return False
+        return self.columns is None or field in self.columns
+
+    def selectin(self, field, value, complement=False):
+        if not self.pushdown(field, complement):
+            return super().selectin(field, value, complement)
+        return self.copy(filter=ds.field(field).isin(list(value)))
+
+    def selecteq(self, field, value, complement=False):
+        if not self.pushdown(field, complement):
+            return super().selecteq(field, value, complement)
+        if value is None:
+            return self.copy(filter=ds.field(field).is_null())
+        return self.copy(filter=ds.field(field) == value)
+
+
+RACE = "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race"
+ETHNICITY = "http://hl7.org/fhir/StructureDefinition/us-core-ethnicity"
+
+
+# a getter for the value at a path like "code.coding[0].code"
+def path(text):
+    steps = compile_path(text)
+    return lambda resource: get_path(resource, steps)
+
+
+# a getter for a path into the extension with the given url
+def extension(url, text):
+    steps = compile_path(text)
+
+    def get(resource):
+        for item in resource.get("extension") or ():
+            if item.get("url") == url:
+                return get_path(item, steps)
+        return None
+
+    return get
+
+
+# the system, code and display of the first Coding of a
+# CodeableConcept as three code columns
+def coding(name, prefix):
+    return [
+        (name + "_system", path(prefix + ".coding[0].system"), "code"),
+        (name + "_code", path(prefix + ".coding[0].code"), "code"),
+        (name + "_display", path(prefix + ".coding[0].display"), "code"),
+    ]
+
+
+def subject():
+    return [
+        ("subject", path("subject.reference"), "string"),
+        ("subject_display", path("subject.display"), "string"),
+    ]
+
+
+# the columns of the flat form of each resource type:
+# (name, getter, kind). kind is "string", "double" or
+# "code"; code columns are dictionary encoded
+flat_columns = {
+    "Patient": [
+        ("id", path("id"), "string"),
+        ("identifier", path("identifier[0].value"), "string"),
+        ("gender", path("gender"), "code"),
+        ("birth_date", path("birthDate"), "string"),
+        ("deceased_date", path("deceasedDateTime"), "string"),
+        ("race", extension(RACE, "valueCodeableConcept.coding[0].code"), "code"),
+        (
+            "ethnicity",
+            extension(ETHNICITY, "valueCodeableConcept.coding[0].code"),
+            "code",
+        ),
+        ("marital_status", path("marital_status.coding[0].code"), "code"),
+    ],
+    "Procedure": [("id", path("id"), "string")]
+    + subject()
+    + [("performed", path("performedDateTime"), "string")]
+    + coding("code", "code")
+    + [("note", path("note[0].text"), "string")],
+    "Condition": [("id", path("id"), "string")]
+    + subject()
+    + [
+        ("onset", path("onsetDateTime"), "string"),
+        ("asserted", path("assertedDate"), "string"),
+    ]
+    + coding("code", "code")
+    + [
+        ("body_site_code", path("bodySite[0].coding[0].code"), "code"),
+        ("severity_code", path("severity.coding[0].code"), "code"),
+        ("note", path("note[0].text"), "string"),
+    ],
+    "Observation": [("id", path("id"), "string")]
+    + subject()
+    + [
+        ("status", path("status"), "code"),
+        ("effective", path("effectiveDateTime"), "string"),
+    ]
+    + coding("code", "code")
+    + [
+        ("value_quantity", path("valueQuantity.value"), "double"),
+        ("value_unit", path("valueQuantity.unit"), "code"),
+        ("value_code", path("valueCodeableConcept.coding[0].code"), "code"),
+        ("value_string", path("valueString"), "string"),
+        ("note", path("note[0].text"), "string"),
+    ],
+    "MedicationDispense": [("id", path("id"), "string")]
+    + subject()
+    + [("when_handed_over", path("whenHandedOver"), "string")]
+    + coding("medication", "medicationCodeableConcept")
+    + [
+        ("quantity", path("quantity.value"), "double"),
+        ("days_supply", path("daysSupply.value"), "double"),
+        ("note", path("note[0].text"), "string"),
+    ],
+    "MedicationRequest": [("id", path("id"), "string")]
+    + subject()
+    + [
+        ("status", path("status"), "code"),
+        ("authored_on", path("authoredOn"), "string"),
+    ]
+    + coding("medication", "medicationCodeableConcept")
+    + [("note", path("note[0].text"), "string")],
+    "MedicationStatement": [("id", path("id"), "string")]
+    + subject()
+    + [
+        ("status", path("status"), "code"),
+        ("start", path("effectivePeriod.start"), "string"),
+        ("end", path("effectivePeriod.end"), "string"),
+    ]
+    + coding("medication", "medicationCodeableConcept")
+    + [
+        ("reason_code", path("reasonCode[0].coding[0].code"), "code"),
+        ("route_code", path("dosage[0].route.coding[0].code"), "code"),
+        ("nct", path("extension[0].valueString"), "string"),
+        ("note", path("note[0].text"), "string"),
+    ],
+    "MedicationAdministration": [("id", path("id"), "string")]
+    + subject()
+    + [
+        ("status", path("status"), "code"),
+        ("start", path("effectivePeriod.start"), "string"),
+        ("end", path("effectivePeriod.end"), "string"),
+    ]
+    + coding("medication", "medicationCodeableConcept")
+    + [
+        ("route_code", path("dosage.route.coding[0].code"), "code"),
+        ("dose_value", path("dosage.dose.value"), "double"),
+        ("dose_unit", path("dosage.dose.unit"), "code"),
+        ("note", path("note[0].text"), "string"),
+    ],
+}
+
+
+def flat_header(resourceType):
+    return tuple(name for name, _, _ in flat_columns[resourceType])
+
+
+# the values of the flat columns of a resource. doubles
+# that are not numbers are written as null
+def flatten(resource):
+    values = []
+    for _, get, kind in flat_columns[resource["resourceType"]]:
+        value = get(resource)
+        if value is not None:
+            if kind == "double":
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = None
+            elif not isinstance(value, str):
+                value = str(value)
+        values.append(value)
+    return tuple(values)
+
+
+# the resources built from a table in their flat form
+def flat(table, resourceType):
+    return FlatView(table, resourceType)
+
+
+class FlatView(Table):
+    def __init__(self, source, resourceType):
+        if resourceType not in flat_columns:
+            raise KeyError(resourceType)
+        self.source = source
+        self.resourceType = resourceType
+
+    def __iter__(self):
+        yield flat_header(self.resourceType)
+        for resource in resources(self.source, self.resourceType):
+            yield flatten(resource)
+
+
+# write the resources built from a table as a Parquet file
+# of their flat form, one row group of row_group_size
+# resources at a time
+def to_parquet(table, resourceType, source, row_group_size=65536, compression="snappy"):
+    with ParquetSink(source, resourceType, row_group_size, compression) as sink:
+        for chunk in chunks(resources(table, resourceType), row_group_size):
+            sink.send(chunk)
+
+
+# a sink for fhir_petl.sinks.tee writing the flat form of
+# the resources as a Parquet file, one row group of
+# row_group_size resources at a time. when the export fails
+# the buffered resources are dropped and the file is closed
+class ParquetSink:
+    def __init__(
+        self, source, resourceType, row_group_size=65536, compression="snappy"
+    ):
+        if pa is None:
+            raise ImportError("Parquet output requires the pyarrow package")
+        columns = flat_columns[resourceType]
+        kinds = {"string": pa.string(), "code": pa.string(), "double": pa.float64()}
+        self.source = source
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([(name, kinds[kind]) for name, _, kind in columns])
+        codes = [name for name, _, kind in columns if kind == "code"]
+        self.writer = pq.ParquetWriter(
+            source, self.schema, compression=compression, use_dictionary=codes
+        )
+        self.rows = []
+        self.resources = 0
+        self.row_groups = 0
+
+    def send(self, resources):
+        self.rows.extend(map(flatten, resources))
+        self.resources += len(resources)
+        size = self.row_group_size
+        if len(self.rows) >= size:
+            rows = self.rows
+            end = len(rows) - len(rows) % size
+            for start in range(0, end, size):
+                self.write(rows[start : start + size])
+            self.rows = rows[end:]
+
+    def write(self, rows):
+        arrays = [
+            pa.array(values, type=field.type)
+            for values, field in zip(zip(*rows), self.schema)
+        ]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.row_groups += 1
+
+    def close(self):
+        if self.rows:
+            self.write(self.rows)
+            self.rows = []
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.rows = []
+            self.writer.close()
+        return False
+
+    def summary(self):
+        return {
+            "source": self.source,
+            "resources": self.resources,
+            "row_groups": self.row_groups,
+        }
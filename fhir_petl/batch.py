@@ -0,0 +1,114 @@
+from time import perf_counter
+import argparse
+import json
+import os
+import sys
+import petl as etl
+from fhir_petl.profile import Profile
+from fhir_petl.util import parallel, preprocess
+
+
+# a preprocessing job: read input (tab separated when the
+# name ends in .txt or .tsv), keep the rows whose filter
+# field is one of the filter values, preprocess with sort
+# and ids and write the result to output as CSV. options
+# go to preprocess (convert, key, namespace, memory, ...)
+class Job:
+    def __init__(
+        self, input, output, sort=None, ids=None, filter=None, delimiter=None, **options
+    ):
+        self.input = input
+        self.output = output
+        self.sort = sort
+        self.ids = ids
+        self.filter = filter
+        self.delimiter = delimiter
+        self.options = options
+
+    def read(self):
+        delimiter = self.delimiter
+        if delimiter is None:
+            delimiter = "\t" if self.input.endswith((".txt", ".tsv")) else ","
+        return etl.io.csv.fromcsv(self.input, delimiter=delimiter)
+
+    def run(self):
+        start = perf_counter()
+        profile = Profile()
+        table = profile.table(self.read(), "read")
+        if self.filter:
+            field, values = self.filter
+            table = table.selectin(field, set(values))
+        table = preprocess(table, self.sort, self.ids, **self.options)
+        profile.table(table, "write").tocsv(self.output)
+        stages = profile.stages
+        return {
+            "input": self.input,
+            "output": self.output,
+            "rows_read": stages["read"].rows_out,
+            "rows_written": stages["write"].rows_out,
+            "seconds": round(perf_counter() - start, 3),
+        }
+
+
+def run_job(n, job):
+    return n, job.run()
+
+
+# run independent preprocessing jobs in a pool of worker
+# processes, the largest inputs first so the run takes
+# about as long as the largest job. returns the report of
+# each job, in the order of jobs
+def run_batch(jobs, workers=None):
+    jobs = list(jobs)
+    order = sorted(range(len(jobs)), key=lambda n: -input_size(jobs[n]))
+    tasks = ((n, jobs[n]) for n in order)
+    reports = [None] * len(jobs)
+    if workers is None:
+        workers = min(len(jobs), os.cpu_count() or 1)
+    if workers > 1:
+        results = parallel(run_job, tasks, workers, ordered=False)
+    else:
+        results = (run_job(*task) for task in tasks)
+    for n, report in results:
+        reports[n] = report
+    return reports
+
+
+def input_size(job):
+    try:
+        return os.path.getsize(job.input)
+    except OSError:
+        return 0
+
+
+# python -m fhir_petl.batch jobs.json [--workers N] [--root DIR]
+# where jobs.json is a list of Job arguments, e.g.
+# [{"input": "dx.txt", "output": "work/Condition.csv",
+#   "sort": "STUDYID"}]. relative paths are resolved against
+# root. prints the reports as JSON
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run preprocessing jobs")
+    parser.add_argument("jobs", help="JSON file with a list of jobs")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--root", default=".")
+    args = parser.parse_args(argv)
+    with open(args.jobs) as f:
+        specs = json.load(f)
+    jobs = []
+    for spec in specs:
+        spec = dict(spec)
+        for name in ("input", "output"):
+            spec[name] = os.path.join(args.root, spec[name])
+        jobs.append(Job(**spec))
+    start = perf_counter()
+    reports = run_batch(jobs, args.workers)
+    json.dump(
+        {"seconds": round(perf_counter() - start, 3), "jobs": reports},
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
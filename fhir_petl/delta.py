@@ -0,0 +1,161 @@
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+import json
+import os
+import sys
+import zlib
+
+MAGIC = b"fhir-petl-hashes 1\n"
+
+
+CANONICAL = json.JSONEncoder(sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+# the canonical text of a resource, independent of the
+# encoder and of the order of its elements
+def canonical(resource):
+    return CANONICAL.encode(resource).encode("utf8")
+
+
+def digest(data):
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little")
+
+
+# the key ("<type>/<id>"), key hash and content hash of
+# each resource, computed where the resources are built.
+# encode has to write the canonical text of a resource
+def digests(resources, encode=canonical):
+    result = []
+    for resource in resources:
+        key = resource["resourceType"] + "/" + resource["id"]
+        result.append((key, digest(key.encode("utf8")), digest(encode(resource))))
+    return result
+
+
+# the content hashes of an export: sorted arrays of 8 byte
+# key hashes and content hashes, and the keys themselves in
+# the same order, compressed. the arrays load without
+# parsing and are searched by bisection; the keys are only
+# decompressed to list the tombstones
+class HashManifest:
+    def __init__(self, keys=None, hashes=None, names=b""):
+        self.keys = keys if keys is not None else array("Q")
+        self.hashes = hashes if hashes is not None else array("Q")
+        self.names = names
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def key_names(self):
+        if not self.names:
+            return []
+        return zlib.decompress(self.names).decode("utf8").split("\n")
+
+    def save(self, path):
+        keys, hashes = self.keys, self.hashes
+        if sys.byteorder == "big":
+            keys, hashes = array("Q", keys), array("Q", hashes)
+            keys.byteswap()
+            hashes.byteswap()
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(keys).to_bytes(8, "little"))
+            f.write(keys.tobytes())
+            f.write(hashes.tobytes())
+            f.write(self.names)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError("%s is not a hash manifest" % path)
+        start = len(MAGIC) + 8
+        count = int.from_bytes(data[len(MAGIC) : start], "little")
+        keys, hashes = array("Q"), array("Q")
+        keys.frombytes(data[start : start + 8 * count])
+        hashes.frombytes(data[start + 8 * count : start + 16 * count])
+        if sys.byteorder == "big":
+            keys.byteswap()
+            hashes.byteswap()
+        return HashManifest(keys, hashes, data[start + 16 * count :])
+
+
+# an incremental export against the manifest of the previous
+# run (none on the first run). to_json only writes the new
+# and changed resources; afterwards the keys that were not
+# exported again are the tombstones, and save writes the
+# manifest for the next run
+class Delta:
+    def __init__(self, previous=None):
+        if isinstance(previous, str):
+            if os.path.exists(previous):
+                previous = HashManifest.load(previous)
+            else:
+                previous = None
+        self.previous = previous or HashManifest()
+        self.seen = bytearray(len(self.previous))
+        self.keys = array("Q")
+        self.hashes = array("Q")
+        self.names = []
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    # keep the lines of the resources that are new or changed
+    def filter(self, lines, digests):
+        previous = self.previous
+        seen = self.seen
+        result = []
+        for line, (name, key, content) in zip(lines, digests):
+            self.keys.append(key)
+            self.hashes.append(content)
+            self.names.append(name)
+            i = previous.find(key)
+            if i < 0:
+                self.new += 1
+                result.append(line)
+                continue
+            seen[i] = 1
+            if previous.hashes[i] == content:
+                self.unchanged += 1
+            else:
+                self.changed += 1
+                result.append(line)
+        return result
+
+    def tombstones(self):
+        if 0 not in self.seen:
+            return []
+        names = self.previous.key_names()
+        return [name for name, seen in zip(names, self.seen) if not seen]
+
+    def manifest(self):
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        return HashManifest(
+            array("Q", (self.keys[i] for i in order)),
+            array("Q", (self.hashes[i] for i in order)),
+            (
+                zlib.compress("\n".join(self.names[i] for i in order).encode("utf8"))
+                if order
+                else b""
+            ),
+        )
+
+    def save(self, path):
+        self.manifest().save(path)
+
+    def summary(self):
+        return {
+            "new": self.new,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+            "deleted": self.seen.count(0),
+        }
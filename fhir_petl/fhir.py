@@ -1,12 +1,641 @@
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import islice
+from time import perf_counter
 import json
-import petl as etl
+from petl.util.base import Table
+from fhir_petl.delta import canonical, digests
+from fhir_petl.io import (
+    BundleWriter,
+    Checkpoint,
+    ShardWriter,
+    codec_from_name,
+    open_output,
+)
+from fhir_petl.util import (
+    FormattedDateTime,
+    ISODate,
+    FrozenDict,
+    FrozenList,
+    chunks,
+    parallel,
+)
+from fhir_petl.validate import Validator
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def to_json(table, resourceType, source):
-    mapper = types[resourceType]
-    table = table.fieldmap({"data": mapper}, True)
-    etl.io.text.totext(table, source, "utf8", template="{data}\n")
-    return table
+
+# write the resources built from a table as NDJSON. the
+# encoder is the name of one of the encoders or any
+# function that turns a resource dict into a line of bytes.
+# with workers the rows are serialized in chunks by a
+# pool of processes, keeping the order of the table
+# unless ordered is false. the output is compressed as
+# it is written when a compression codec is given or the
+# file name ends in .gz, .bz2 or .zst. with shard_records
+# or shard_bytes the output is split into numbered shards
+# next to source, listed in a manifest. with bundle set to
+# "batch" or "transaction" each line is a Bundle of up to
+# bundle_size entries instead of a single resource; shards
+# then hold whole Bundles and count resources. a Validator
+# checks every resource as it is serialized; its report
+# counts the errors by rule. with a Delta only the resources
+# that are new or changed since its previous manifest are
+# written. with a checkpoint file the progress is saved
+# every checkpoint_rows rows; when an export is run again
+# after a crash, the output is truncated to the last
+# checkpoint and the rows before it are skipped without
+# being serialized. checkpoints need plain ordered output:
+# no compression, shards, Bundles or Delta. engine
+# "columns" serializes batches of rows column by column
+# instead of building a dict per row, with the same output;
+# it writes plain resources, without Bundles, a Validator
+# or a Delta. a Profile collects the time spent building
+# each element, encoding and writing
+def to_json(
+    table,
+    resourceType,
+    source,
+    encoder="json",
+    workers=None,
+    chunksize=1000,
+    ordered=True,
+    compression=None,
+    level=None,
+    threads=None,
+    shard_records=None,
+    shard_bytes=None,
+    bundle=None,
+    bundle_size=100,
+    validator=None,
+    delta=None,
+    checkpoint=None,
+    checkpoint_rows=100000,
+    engine="rows",
+    profile=None,
+):
+    if resourceType not in plans:
+        raise KeyError(resourceType)
+    if engine not in ("rows", "columns"):
+        raise ValueError("unknown engine %r" % engine)
+    if engine == "columns" and (bundle or validator or delta is not None):
+        raise ValueError("the columns engine writes plain resources only")
+    offset = None
+    if checkpoint:
+        if (
+            compression
+            or codec_from_name(source)
+            or shard_records
+            or shard_bytes
+            or bundle
+            or delta is not None
+            or not ordered
+        ):
+            raise ValueError("checkpoints need plain, ordered NDJSON output")
+        checkpoint = Checkpoint(checkpoint, source, resourceType, checkpoint_rows)
+        offset = checkpoint.bytes
+    lines = serialize(
+        table,
+        resourceType,
+        encoder,
+        workers,
+        chunksize,
+        ordered,
+        bool(bundle),
+        (validator.sample, validator.rate) if validator else None,
+        delta is not None,
+        checkpoint.rows if checkpoint else 0,
+        engine,
+        profile is not None,
+    )
+    start = perf_counter()
+    with open_ndjson(
+        source,
+        encoder,
+        compression,
+        level,
+        threads,
+        shard_records,
+        shard_bytes,
+        bundle,
+        bundle_size,
+        offset,
+    ) as f:
+        for chunk, report, hashes, timings in lines:
+            rows = len(chunk)
+            if hashes is not None:
+                chunk = delta.filter(chunk, hashes)
+            if timings:
+                written = perf_counter()
+                f.writelines(chunk)
+                profile.add(
+                    "write",
+                    perf_counter() - written,
+                    rows,
+                    len(chunk),
+                    sum(map(len, chunk)),
+                )
+                profile.merge(timings)
+            else:
+                f.writelines(chunk)
+            if report:
+                validator.merge(report)
+            if checkpoint:
+                checkpoint.update(f, rows)
+    if checkpoint:
+        checkpoint.remove()
+    if profile is not None:
+        stage = profile.stage("write")
+        profile.add("to_json", perf_counter() - start, rows_out=stage.rows_out)
+    return ResourceView(table, resourceType)
+
+
+# open the NDJSON output of to_json for writing encoded
+# lines, with the same compression, sharding and Bundle
+# options
+@contextmanager
+def open_ndjson(
+    source,
+    encoder="json",
+    compression=None,
+    level=None,
+    threads=None,
+    shard_records=None,
+    shard_bytes=None,
+    bundle=None,
+    bundle_size=100,
+    offset=None,
+):
+    if bundle not in (None, "batch", "transaction"):
+        raise ValueError("unknown bundle type %r" % bundle)
+    encode = get_encoder(encoder)
+    if shard_records or shard_bytes:
+        output = ShardWriter(
+            source, shard_records, shard_bytes, compression, level, threads
+        )
+    else:
+        output = open_output(source, compression, level, threads, offset)
+    with output as f:
+        if bundle:
+            with BundleWriter(f, bundle, bundle_size, encode) as b:
+                yield b
+        else:
+            yield f
+
+
+# serialize the rows of a table into chunks of encoded
+# lines, in this process or in a pool of workers. the
+# encoder has to be a name or a picklable function when
+# workers are used. with entries each resource is wrapped
+# in a Bundle entry. with validate, the sample size and
+# rate of a Validator, the resources are validated and
+# each chunk comes with the report of its validator. with
+# digest it also comes with the key and content hashes of
+# its resources. the first skip rows are read but not
+# serialized. with engine "columns" the chunks are
+# serialized by a ColumnSerializer. with profile each chunk
+# also comes with its timings by stage
+def serialize(
+    table,
+    resourceType,
+    encoder="json",
+    workers=None,
+    chunksize=1000,
+    ordered=True,
+    entries=False,
+    validate=None,
+    digest=False,
+    skip=0,
+    engine="rows",
+    profile=False,
+):
+    it = iter(table)
+    try:
+        header = tuple(map(str, next(it)))
+    except StopIteration:
+        return
+    if skip:
+        it = islice(it, skip, None)
+    if engine == "columns":
+        fn = serialize_columns
+        tasks = (
+            (resourceType, header, rows, encoder, profile)
+            for rows in chunks(it, chunksize)
+        )
+    else:
+        fn = serialize_chunk
+        tasks = (
+            (
+                resourceType,
+                header,
+                rows,
+                encoder,
+                entries,
+                validate,
+                digest,
+                profile,
+            )
+            for rows in chunks(it, chunksize)
+        )
+    if workers:
+        yield from parallel(fn, tasks, workers, ordered)
+    else:
+        for task in tasks:
+            yield fn(*task)
+
+
+def serialize_chunk(
+    resourceType,
+    header,
+    rows,
+    encoder,
+    entries=False,
+    validate=None,
+    digest=False,
+    profile=False,
+):
+    timings = {} if profile else None
+    clock = Clock(timings)
+    if profile:
+        build = compile_timed_plan(resourceType, header, timings)
+    else:
+        build = compile_plan(resourceType, header)
+    encode = get_encoder(encoder)
+    width = len(header)
+    resources = [build(pad(row, width)) for row in rows]
+    clock.lap("build", len(rows), len(resources))
+    report = None
+    if validate is not None:
+        validator = Validator(resourceType, *validate)
+        validator.check(resources)
+        report = validator.report()
+        clock.lap("validate", len(resources), len(resources))
+    hashes = None
+    if digest:
+        hashes = digests(resources, canonical_encoder())
+        clock.lap("hash", len(resources), len(resources))
+    if entries:
+        resources = map(to_entry, resources)
+    lines = list(map(encode, resources))
+    clock.lap("encode", len(lines), len(lines))
+    return lines, report, hashes, timings
+
+
+def serialize_columns(resourceType, header, rows, encoder, profile=False):
+    timings = {} if profile else None
+    clock = Clock(timings)
+    lines = column_serializer(resourceType, header, encoder)(rows)
+    clock.lap("columns", len(rows), len(lines))
+    return lines, None, None, timings
+
+
+# times the stages of serializing a chunk into timings, in
+# the form Profile.merge takes. without timings it does
+# nothing
+class Clock:
+    def __init__(self, timings):
+        self.timings = timings
+        if timings is not None:
+            self.last = perf_counter()
+
+    def lap(self, name, rows_in, rows_out):
+        if self.timings is None:
+            return
+        now = perf_counter()
+        self.timings[name] = {
+            "seconds": now - self.last,
+            "rows_in": rows_in,
+            "rows_out": rows_out,
+        }
+        self.last = now
+
+
+# a Bundle entry that creates or updates the resource
+# under its own id
+def to_entry(resource):
+    return {
+        "fullUrl": "urn:uuid:" + resource["id"],
+        "resource": resource,
+        "request": {
+            "method": "PUT",
+            "url": resource["resourceType"] + "/" + resource["id"],
+        },
+    }
+
+
+# build the resource dicts for the rows of a table. the
+# resource plan is compiled once from the header
+def resources(table, resourceType):
+    it = iter(table)
+    try:
+        header = tuple(map(str, next(it)))
+    except StopIteration:
+        return
+    build = compile_plan(resourceType, header)
+    width = len(header)
+    for row in it:
+        yield build(pad(row, width))
+
+
+# short rows read missing fields as None, like a Record
+def pad(row, width):
+    if len(row) < width:
+        return tuple(row) + (None,) * (width - len(row))
+    return row
+
+
+# a table with a single "data" field holding the
+# serialized resource for each row of the source
+class ResourceView(Table):
+    def __init__(self, source, resourceType):
+        if resourceType not in plans:
+            raise KeyError(resourceType)
+        self.source = source
+        self.resourceType = resourceType
+
+    def __iter__(self):
+        yield ("data",)
+        for resource in resources(self.source, self.resourceType):
+            yield (json.dumps(resource),)
+
+
+# the stdlib encoder writes exactly what json.dumps
+# returns, so its output is byte for byte the same as
+# writing the "data" field of a ResourceView as text
+def encode_json(resource):
+    return (json.dumps(resource) + "\n").encode("utf8")
+
+
+# orjson writes compact separators and raw UTF-8, so
+# its lines parse to the same resources but are not
+# byte identical to the stdlib encoder
+def encode_orjson(resource):
+    return orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE)
+
+
+encoders = {
+    "json": encode_json,
+    "orjson": encode_orjson,
+}
+
+
+def get_encoder(encoder):
+    if callable(encoder):
+        return encoder
+    if encoder not in encoders:
+        raise KeyError(encoder)
+    if encoder == "orjson" and orjson is None:
+        raise ImportError("the orjson encoder requires the orjson package")
+    return encoders[encoder]
+
+
+# the FragmentEncoder of an encoder, shared by every chunk
+# serialized in this process
+@lru_cache(maxsize=None)
+def fragment_encoder(encoder):
+    return FragmentEncoder(get_encoder(encoder))
+
+
+# the canonical text hashed by fhir_petl.delta, with the
+# shared parts of resources spliced in like fragments. it
+# writes the same bytes as canonical, without a newline,
+# so the manifests of to_json match delta.digests
+@lru_cache(maxsize=None)
+def canonical_encoder():
+    return FragmentEncoder(canonical, sort_keys=True).dict
+
+
+# an encoder that splices cached JSON text into its output,
+# used by the columns engine to encode single elements. the
+# values returned by the memoized builders (codes and
+# race/ethnicity extensions) are the same objects for the
+# same input, so their encoded text is cached by identity.
+# the rest of the resource is encoded with the wrapped
+# encoder, using the separators it writes, so the output is
+# byte for byte what the encoder writes for the whole
+# resource. with sort_keys the elements of
+# every dict are written sorted by key; the wrapped encoder
+# has to sort the cached values the same way
+class FragmentEncoder:
+    def __init__(self, encode, size=65536, sort_keys=False):
+        self.encode = encode
+        self.sort_keys = sort_keys
+        probe = encode({"a": [0, 0]}).rstrip(b"\n")
+        self.colon = probe[4 : probe.index(b"[")]
+        self.comma = probe[probe.index(b"0") + 1 : probe.rindex(b"0")]
+        self.size = size
+        self.keys = {}
+        self.fragments = {}
+
+    def __call__(self, resource):
+        return self.dict(resource) + b"\n"
+
+    def dict(self, x):
+        if not x:
+            return self.text(x)
+        keys = self.keys
+        parts = []
+        items = sorted(x.items()) if self.sort_keys else x.items()
+        for key, value in items:
+            text = keys.get(key)
+            if text is None:
+                text = keys[key] = self.text(key) + self.colon
+            parts.append(text + self.value(value))
+        return b"{" + self.comma.join(parts) + b"}"
+
+    def value(self, x):
+        kind = type(x)
+        if kind is FrozenDict or kind is FrozenList:
+            fragment = self.fragments.get(id(x))
+            if fragment is not None and fragment[0] is x:
+                return fragment[1]
+            if len(self.fragments) >= self.size:
+                self.fragments.clear()
+            text = self.text(x)
+            self.fragments[id(x)] = (x, text)
+            return text
+        if kind is dict:
+            return self.dict(x)
+        return self.text(x)
+
+    def text(self, x):
+        return self.encode(x).rstrip(b"\n")
+
+
+# the columnar engine of to_json. a batch of rows is turned
+# into one column of JSON fragments ('"key": value' or None
+# when the element is absent) per step of the plan, and the
+# lines of the batch are joined from the columns. equal
+# inputs of a column are built and encoded once, so e.g. a
+# status, a date or a subject costs a dict lookup per row.
+# the lines are byte for byte what the encoder writes for
+# the resources built from the rows
+@lru_cache(maxsize=256)
+def column_serializer(resourceType, header, encoder):
+    return ColumnSerializer(resourceType, header, fragment_encoder(encoder))
+
+
+NOKEY = object()
+MISSING = object()
+
+
+# the key equal inputs of a column are memoized under, or
+# NOKEY when an input can't be memoized. numbers are keyed
+# with their type and float text since 1, 1.0 and True are
+# equal but encode differently
+def column_key(value):
+    kind = type(value)
+    if kind is str or value is None:
+        return value
+    if kind is ISODate:
+        return (kind, value)
+    if kind is int or kind is bool or kind is date:
+        return (kind, value)
+    if kind is float:
+        return (kind, repr(value))
+    if kind is datetime and value.tzinfo is None:
+        return (kind, value)
+    if (
+        kind is FormattedDateTime
+        and type(value.dt) is datetime
+        and value.dt.tzinfo is None
+    ):
+        return (kind, value.dt, value.format)
+    return NOKEY
+
+
+class ColumnSerializer:
+    def __init__(self, resourceType, header, fragments, size=65536):
+        self.fragments = fragments
+        self.size = size
+        self.width = len(header)
+        self.id_index = header.index("id")
+        self.id_prefix = self.prefix("id")
+        self.type_text = self.prefix("resourceType") + fragments.text(resourceType)
+        index = index_header(header)
+        columns = [
+            self.compile(key, source, build, index)
+            for key, source, build in plans[resourceType]
+        ]
+        self.columns = [column for column in columns if column]
+
+    def prefix(self, key):
+        return self.fragments.text(key) + self.fragments.colon
+
+    def __call__(self, rows):
+        width = self.width
+        rows = [pad(row, width) for row in rows]
+        text = self.fragments.text
+        prefix = self.id_prefix
+        columns = [[prefix + text(row[self.id_index]) for row in rows]]
+        columns.append([self.type_text] * len(rows))
+        columns.extend(column(rows) for column in self.columns)
+        join = self.fragments.comma.join
+        return [b"{" + join(filter(None, parts)) + b"}\n" for parts in zip(*columns)]
+
+    # compile a step of the plan into a function from rows to
+    # a column of fragments, skipping fields missing from
+    # the header like compile_step
+    def compile(self, key, source, build, index):
+        value_text = self.fragments.value
+        if isinstance(source, str):
+            if source not in index:
+                return None
+            i = index[source]
+            if key is None:
+
+                def pair_fragment(value):
+                    pair = build(value)
+                    if not pair:
+                        return None
+                    return self.prefix(pair[0]) + value_text(pair[1])
+
+                fragment = pair_fragment
+            elif build is None:
+                prefix = self.prefix(key)
+
+                def value_fragment(value):
+                    return prefix + value_text(value)
+
+                fragment = value_fragment
+            else:
+                prefix = self.prefix(key)
+
+                def build_fragment(value):
+                    return prefix + value_text(build(value))
+
+                fragment = build_fragment
+
+            return self.memoized(
+                lambda rows: [row[i] for row in rows],
+                lambda value: fragment(value) if value else None,
+                column_key,
+            )
+
+        if isinstance(source, tuple):
+            indices = tuple(index.get(field) for field in source)
+            prefix = self.prefix(key)
+
+            def fields_fragment(values):
+                value = build(*values)
+                if value is None:
+                    return None
+                return prefix + value_text(value)
+
+            def values(rows):
+                return [
+                    tuple(None if i is None else row[i] for i in indices)
+                    for row in rows
+                ]
+
+            def key_of(values):
+                keys = tuple(map(column_key, values))
+                return NOKEY if NOKEY in keys else keys
+
+            return self.memoized(values, fields_fragment, key_of)
+
+        # nested plans build their value per row
+        step = compile_step(key, source, build, index)
+        prefix = self.prefix(key)
+
+        def column(rows):
+            fragments = []
+            for row in rows:
+                result = {}
+                step(row, result)
+                if key in result:
+                    fragments.append(prefix + value_text(result[key]))
+                else:
+                    fragments.append(None)
+            return fragments
+
+        return column
+
+    def memoized(self, values, fragment, key_of):
+        memo = {}
+        size = self.size
+
+        def column(rows):
+            fragments = []
+            append = fragments.append
+            for value in values(rows):
+                key = key_of(value)
+                if key is NOKEY:
+                    append(fragment(value))
+                    continue
+                text = memo.get(key, MISSING)
+                if text is MISSING:
+                    if len(memo) >= size:
+                        memo.clear()
+                    text = memo[key] = fragment(value)
+                append(text)
+            return fragments
+
+        return column
 
 
 def to_timing(x):
@@ -19,7 +648,39 @@ def to_timing(x):
     return timing
 
 
+# size of the caches of Coding and CodeableConcept dicts.
+# only inputs made of strings and None are cached: the
+# caches compare keys with ==, and 1, 1.0 and True are
+# equal but encode differently
+CODE_CACHE_SIZE = 4096
+
+
+def plain(x):
+    if type(x) is tuple:
+        for item in x:
+            if not (type(item) is str or item is None or plain(item)):
+                return False
+        return True
+    return type(x) is str or x is None
+
+
 def to_codeable_concept(x):
+    if isinstance(x, list):
+        many = tuple(x)
+        if plain(many):
+            return cached_codeable_concept(many, True)
+    elif plain(x):
+        return cached_codeable_concept(x, False)
+    return build_codeable_concept(x)
+
+
+@lru_cache(maxsize=CODE_CACHE_SIZE)
+def cached_codeable_concept(x, many):
+    result = map(tuple_to_code, x) if many else [tuple_to_code(x)]
+    return FrozenDict(coding=FrozenList(c for c in result if c.get("code")))
+
+
+def build_codeable_concept(x):
     if isinstance(x, list):
         result = map(tuple_to_code, x)
     else:
@@ -68,48 +729,19 @@ def to_range(x):
     return range
 
 
-def to_ratio(x):
-    numerator, denominator = x
-    ratio = {}
-    if numerator:
-        ratio["numerator"] = to_quantity(numerator)
-    if denominator:
-        ratio["denominator"] = to_quantity(denominator)
-    return ratio
-
-
-def to_quantity(x):
-    value, comparator, unit, system, code = x
-    quantity = {}
-    if value:
-        quantity["value"] = value
-    if comparator:
-        quantity["comparator"] = comparator
-    if unit:
-        quantity["unit"] = unit
-    if system:
-        quantity["system"] = system
-    if code:
-        quantity["code"] = code
-    return quantity
-
-
-def to_simple_quantity(x):
-    value, unit, system, code = x
-    return to_quantity((value, None, unit, system, code))
+def tuple_to_code(x):
+    if plain(x):
+        return cached_tuple_to_code(x)
+    return build_code(x)
 
 
-def to_range(x):
-    low, high = x
-    range = {}
-    if low:
-        range["low"] = to_simple_quantity(low)
-    if high:
-        range["high"] = to_simple_quantity(high)
-    return range
+@lru_cache(maxsize=CODE_CACHE_SIZE)
+def cached_tuple_to_code(x):
+    code = build_code(x)
+    return code if code is None else FrozenDict(code)
 
 
-def tuple_to_code(x):
+def build_code(x):
     if len(x) == 2:
         display = None
         system, code = x
@@ -134,282 +766,427 @@ def tuple_to_code(x):
     return None
 
 
-def has(rec, field):
-    return field in rec.flds and rec[field]
+# hit and miss statistics of the code caches
+def code_cache_info():
+    return {
+        "tuple_to_code": cached_tuple_to_code.cache_info(),
+        "to_codeable_concept": cached_codeable_concept.cache_info(),
+        "to_race_ethnicity": cached_race_ethnicity.cache_info(),
+    }
 
 
-def to_dosage(rec):
-    dosage = {}
-    doseAndRate = {}
-    if has(rec, "sequence"):
-        dosage["sequence"] = rec["sequence"]
-    if has(rec, "dosage_text"):
-        dosage["text"] = rec["dosage_text"]
-    if has(rec, "additionalInstruction"):
-        dosage["additionalInstruction"] = to_codeable_concept(
-            rec["additionalInstruction"]
-        )
-    if has(rec, "patientInstruction"):
-        dosage["patientInstruction"] = rec["patientInstruction"]
-    if has(rec, "timing"):
-        dosage["timing"] = to_timing(rec["timing"])
-    if has(rec, "asNeededBoolean"):
-        dosage["asNeededBoolean"] = rec["asNeededBoolean"]
-    if has(rec, "asNeeded"):
-        dosage["asNeededCodeableConcept"] = to_codeable_concept(rec["asNeeded"])
-    if has(rec, "site"):
-        dosage["site"] = to_codeable_concept(rec["site"])
-    if has(rec, "route"):
-        dosage["route"] = to_codeable_concept(rec["route"])
-    if has(rec, "method"):
-        dosage["method"] = to_codeable_concept(rec["method"])
-    if has(rec, "type"):
-        doseAndRate["type"] = to_codeable_concept(rec["type"])
-    if has(rec, "doseRange"):
-        doseAndRate["doseRange"] = to_ratio(rec["doseRange"])
-    if has(rec, "doseQuantity"):
-        doseAndRate["doseQuantity"] = to_simple_quantity(rec["doseQuantity"])
-    if has(rec, "rateRatio"):
-        doseAndRate["rateRatio"] = to_ratio(rec["rateRatio"])
-    if has(rec, "rateRange"):
-        doseAndRate["rateRange"] = to_range(rec["rateRange"])
-    if has(rec, "rateQuantity"):
-        doseAndRate["rateQuantity"] = to_simple_quantity(rec["rateQuantity"])
-    if doseAndRate:
-        dosage["doseAndRate"] = [doseAndRate]
-    if has(rec, "maxDosePerPeriod"):
-        dosage["maxDosePerPeriod"] = to_ratio(rec["maxDosePerPeriod"])
-    if has(rec, "maxDosePerAdministration"):
-        dosage["maxDosePerAdministration"] = to_simple_quantity(
-            rec["maxDosePerAdministration"]
-        )
-    if has(rec, "maxDosePerLifetime"):
-        dosage["maxDosePerLifetime"] = to_simple_quantity(rec["maxDosePerLifetime"])
-    return dosage
+def code_cache_clear():
+    cached_tuple_to_code.cache_clear()
+    cached_codeable_concept.cache_clear()
+    cached_race_ethnicity.cache_clear()
 
 
-def to_patient(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "Patient"
-    if has(rec, "subject_id"):
-        result["identifier"] = [
-            {
-                "type": to_codeable_concept(("http://hl7.org/fhir/v2/0203", "ANON")),
-                "system": "http://lifeomic.com/fhir/subject-id",
-                "value": rec["subject_id"],
-            }
-        ]
-    if has(rec, "race"):
-        result["extension"] = [
-            {
-                "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
-                "valueCodeableConcept": to_codeable_concept(rec["race"]),
-            }
-        ]
-    if has(rec, "ethnicity"):
-        result["extension"] = [
+def to_date_time(x):
+    return x.isoformat()
+
+
+# subject references are not cached: there is one per
+# patient, too many to keep
+def to_subject(subject, display=None):
+    if not subject:
+        return None
+    if display:
+        return {"reference": "Patient/" + subject, "display": display}
+    return {"reference": "Patient/" + subject}
+
+
+def to_note(x):
+    return [{"text": x}]
+
+
+def to_meta(x):
+    return {"tag": [tuple_to_code(x)]}
+
+
+def to_period(start, end):
+    period = {}
+    if start:
+        period["start"] = start.isoformat()
+    if end:
+        period["end"] = end.isoformat()
+    return period or None
+
+
+def to_identifier(x):
+    return [
+        {
+            "type": to_codeable_concept(("http://hl7.org/fhir/v2/0203", "ANON")),
+            "system": "http://lifeomic.com/fhir/subject-id",
+            "value": x,
+        }
+    ]
+
+
+def to_race_ethnicity(race, ethnicity):
+    if plain(race) and plain(ethnicity):
+        return cached_race_ethnicity(race, ethnicity)
+    return build_race_ethnicity(race, ethnicity)
+
+
+@lru_cache(maxsize=CODE_CACHE_SIZE)
+def cached_race_ethnicity(race, ethnicity):
+    extension = build_race_ethnicity(race, ethnicity)
+    return extension and FrozenList(map(FrozenDict, extension))
+
+
+def build_race_ethnicity(race, ethnicity):
+    extension = []
+    if ethnicity:
+        extension.append(
             {
                 "url": "http://hl7.org/fhir/StructureDefinition/us-core-ethnicity",
-                "valueCodeableConcept": to_codeable_concept(rec["ethnicity"]),
+                "valueCodeableConcept": to_codeable_concept(ethnicity),
             }
-        ]
-    if has(rec, "race") and has(rec, "ethnicity"):
-        result["extension"] = [
-            {
-                "url": "http://hl7.org/fhir/StructureDefinition/us-core-ethnicity",
-                "valueCodeableConcept": to_codeable_concept(rec["ethnicity"]),
-            },
+        )
+    if race:
+        extension.append(
             {
                 "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
-                "valueCodeableConcept": to_codeable_concept(rec["race"]),
-            },
-        ]
-    if has(rec, "marital_status"):
-        result["marital_status"] = to_codeable_concept(rec["marital_status"])
-    if has(rec, "gender"):
-        result["gender"] = rec["gender"]
-    if has(rec, "birth_date"):
-        result["birthDate"] = rec["birth_date"].isoformat()
-    if has(rec, "death_date"):
-        result["deceasedDateTime"] = rec["death_date"].isoformat()
-    if has(rec, "tag"):
-        result["meta"] = {"tag": [tuple_to_code(rec["tag"])]}
-    return json.dumps(result)
+                "valueCodeableConcept": to_codeable_concept(race),
+            }
+        )
+    return extension or None
+
+
+def to_observation_value(value):
+    if isinstance(value, (int, float)):
+        return "valueQuantity", to_simple_quantity(value)
+    if isinstance(value, tuple):
+        return "valueQuantity", to_simple_quantity(value)
+    if isinstance(value, list):
+        return "valueCodeableConcept", to_codeable_concept(value)
+    if isinstance(value, str):
+        return "valueString", value
+    return None
+
+
+def to_statement_subject(subject, display):
+    return to_subject(subject, str(display) if display else None)
+
+
+def to_nct(x):
+    return [
+        {
+            "url": "http://hl7.org/fhir/StructureDefinition/patient-clinicalTrial-NCT",
+            "valueString": x,
+        }
+    ]
+
+
+def to_dose_and_rate(x):
+    return [x] if x else None
+
+
+# A plan lists the steps that build a resource, in the
+# order the elements appear in the output. Each step is
+# (key, source, build):
+#
+#   source is a field name: when the field is present
+#   and truthy, key is set to build(value). A build of
+#   None copies the value and a key of None means build
+#   returns a (key, value) pair
+#
+#   source is a tuple of field names: key is set to
+#   build(*values) unless it returns None. Fields missing
+#   from the header are passed as None
+#
+#   source is a list of steps: the nested plan builds a
+#   dict and key is set to build(dict) unless it returns
+#   None. A build of None always sets the dict
+dosage_plan = [
+    ("sequence", "sequence", None),
+    ("text", "dosage_text", None),
+    ("additionalInstruction", "additionalInstruction", to_codeable_concept),
+    ("patientInstruction", "patientInstruction", None),
+    ("timing", "timing", to_timing),
+    ("asNeededBoolean", "asNeededBoolean", None),
+    ("asNeededCodeableConcept", "asNeeded", to_codeable_concept),
+    ("site", "site", to_codeable_concept),
+    ("route", "route", to_codeable_concept),
+    ("method", "method", to_codeable_concept),
+]
+
+dose_and_rate_plan = [
+    ("type", "type", to_codeable_concept),
+    ("doseRange", "doseRange", to_ratio),
+    ("doseQuantity", "doseQuantity", to_simple_quantity),
+    ("rateRatio", "rateRatio", to_ratio),
+    ("rateRange", "rateRange", to_range),
+    ("rateQuantity", "rateQuantity", to_simple_quantity),
+]
+
+max_dose_plan = [
+    ("maxDosePerPeriod", "maxDosePerPeriod", to_ratio),
+    ("maxDosePerAdministration", "maxDosePerAdministration", to_simple_quantity),
+    ("maxDosePerLifetime", "maxDosePerLifetime", to_simple_quantity),
+]
+
+plans = {
+    "Procedure": [
+        ("performedDateTime", "date", to_date_time),
+        ("code", "code", to_codeable_concept),
+        ("subject", "subject", to_subject),
+        ("note", "note", to_note),
+    ],
+    "Patient": [
+        ("identifier", "subject_id", to_identifier),
+        ("extension", ("race", "ethnicity"), to_race_ethnicity),
+        ("marital_status", "marital_status", to_codeable_concept),
+        ("gender", "gender", None),
+        ("birthDate", "birth_date", to_date_time),
+        ("deceasedDateTime", "death_date", to_date_time),
+        ("meta", "tag", to_meta),
+    ],
+    "Condition": [
+        ("onsetDateTime", "onset", to_date_time),
+        ("assertedDate", "asserted", to_date_time),
+        ("code", "code", to_codeable_concept),
+        ("bodySite", "bodySite", lambda x: [to_codeable_concept(x)]),
+        ("severity", "severity", to_codeable_concept),
+        ("subject", "subject", to_subject),
+        ("note", "note", to_note),
+        ("meta", "tag", to_meta),
+    ],
+    "Observation": [
+        ("effectiveDateTime", "date", to_date_time),
+        ("code", "code", to_codeable_concept),
+        ("subject", ("subject", "subject_display"), to_subject),
+        (None, "value", to_observation_value),
+        ("note", "note", to_note),
+        ("status", "status", None),
+    ],
+    "MedicationDispense": [
+        ("whenHandedOver", "date", to_date_time),
+        ("medicationCodeableConcept", "medication", to_codeable_concept),
+        ("subject", "subject", to_subject),
+        ("quantity", "quantity", lambda x: {"value": x}),
+        ("daysSupply", "daysSupply", lambda x: {"value": x, "unit": "days"}),
+        ("note", "note", to_note),
+    ],
+    "MedicationRequest": [
+        ("authoredOn", "date", to_date_time),
+        ("medicationCodeableConcept", "medication", to_codeable_concept),
+        ("subject", "subject", to_subject),
+        ("note", "note", to_note),
+        ("status", "status", None),
+    ],
+    "MedicationStatement": [
+        ("extension", "nct", to_nct),
+        ("subject", ("subject", "subject_display"), to_statement_subject),
+        ("effectivePeriod", ("start_date", "end_date"), to_period),
+        ("medicationCodeableConcept", "medication", to_codeable_concept),
+        ("status", "status", None),
+        ("note", "note", to_note),
+        ("reasonCode", "indication", lambda x: [to_codeable_concept(x)]),
+        ("dosage", "route", lambda x: [{"route": to_codeable_concept(x)}]),
+    ],
+    "MedicationAdministration": [
+        ("status", "status", None),
+        ("subject", "subject", to_subject),
+        ("medicationCodeableConcept", "medication", to_codeable_concept),
+        ("effectivePeriod", ("start_date", "end_date"), to_period),
+        ("note", "note", to_note),
+        (
+            "dosage",
+            dosage_plan
+            + max_dose_plan
+            + [step for step in dose_and_rate_plan if step[0] != "doseQuantity"]
+            + [("dose", "doseQuantity", to_simple_quantity)],
+            None,
+        ),
+    ],
+}
+
+
+def index_header(header):
+    index = {}
+    for i, field in enumerate(header):
+        index.setdefault(field, i)
+    return index
+
+
+# compile a step into a function that updates the result
+# from a row. steps for fields missing from the header
+# compile to None and are skipped entirely
+def compile_step(key, source, build, index):
+    if isinstance(source, str):
+        if source not in index:
+            return None
+        i = index[source]
+        if key is None:
+
+            def pair_step(row, result):
+                value = row[i]
+                if value:
+                    pair = build(value)
+                    if pair:
+                        result[pair[0]] = pair[1]
+
+            return pair_step
+
+        if build is None:
+
+            def value_step(row, result):
+                value = row[i]
+                if value:
+                    result[key] = value
+
+            return value_step
+
+        def build_step(row, result):
+            value = row[i]
+            if value:
+                result[key] = build(value)
+
+        return build_step
+
+    if isinstance(source, tuple):
+        indices = tuple(index.get(field) for field in source)
+
+        def fields_step(row, result):
+            value = build(*[None if i is None else row[i] for i in indices])
+            if value is not None:
+                result[key] = value
+
+        return fields_step
+
+    nested = compile_steps(source, index)
+    if build is None:
+
+        def nested_step(row, result):
+            result[key] = nested(row)
+
+        return nested_step
+
+    def nested_build_step(row, result):
+        value = build(nested(row))
+        if value is not None:
+            result[key] = value
+
+    return nested_build_step
+
+
+def compile_steps(steps, index):
+    steps = [compile_step(key, source, make, index) for key, source, make in steps]
+    steps = [step for step in steps if step]
+
+    def build_nested(row):
+        result = {}
+        for step in steps:
+            step(row, result)
+        return result
+
+    return build_nested
+
+
+# compile the plan for a resource type against a table
+# header into a function that builds the resource dict
+# from a row tuple
+@lru_cache(maxsize=256)
+def compile_plan(resourceType, header):
+    index = index_header(header)
+    id_index = header.index("id")
+    steps = [
+        compile_step(key, source, make, index)
+        for key, source, make in plans[resourceType]
+    ]
+    steps = [step for step in steps if step]
+
+    def build_resource(row):
+        result = {"id": row[id_index], "resourceType": resourceType}
+        for step in steps:
+            step(row, result)
+        return result
+
+    return build_resource
+
+
+# compile_plan with the time spent in each step added to
+# timings under "build.<element>"
+def compile_timed_plan(resourceType, header, timings):
+    index = index_header(header)
+    id_index = header.index("id")
+    steps = []
+    for key, source, make in plans[resourceType]:
+        step = compile_step(key, source, make, index)
+        if step:
+            name = "build." + (key or make.__name__)
+            steps.append(timed_step(step, timings.setdefault(name, {})))
+
+    def build_resource(row):
+        result = {"id": row[id_index], "resourceType": resourceType}
+        for step in steps:
+            step(row, result)
+        return result
+
+    return build_resource
+
+
+def timed_step(step, timing):
+    timing.update(seconds=0.0, calls=0)
+
+    def timed(row, result):
+        start = perf_counter()
+        step(row, result)
+        timing["seconds"] += perf_counter() - start
+        timing["calls"] += 1
+
+    return timed
+
+
+@lru_cache(maxsize=256)
+def compile_dosage(header):
+    return compile_steps(
+        dosage_plan
+        + [("doseAndRate", dose_and_rate_plan, to_dose_and_rate)]
+        + max_dose_plan,
+        index_header(header),
+    )
+
+
+def to_dosage(rec):
+    return compile_dosage(tuple(rec.flds))(rec)
+
+
+def to_resource(resourceType, rec):
+    return json.dumps(compile_plan(resourceType, tuple(rec.flds))(rec))
+
+
+def to_patient(rec):
+    return to_resource("Patient", rec)
 
 
 def to_procedure(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "Procedure"
-    if has(rec, "date"):
-        result["performedDateTime"] = rec["date"].isoformat()
-    if has(rec, "code"):
-        result["code"] = to_codeable_concept(rec["code"])
-    if has(rec, "subject"):
-        result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    return json.dumps(result)
+    return to_resource("Procedure", rec)
 
 
 def to_condition(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "Condition"
-    if has(rec, "onset"):
-        result["onsetDateTime"] = rec["onset"].isoformat()
-    if has(rec, "asserted"):
-        result["assertedDate"] = rec["asserted"].isoformat()
-    if has(rec, "code"):
-        result["code"] = to_codeable_concept(rec["code"])
-    if has(rec, "bodySite"):
-        result["bodySite"] = [to_codeable_concept(rec["bodySite"])]
-    if has(rec, "severity"):
-        result["severity"] = to_codeable_concept(rec["severity"])
-    if has(rec, "subject"):
-        result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    if has(rec, "tag"):
-        result["meta"] = {"tag": [tuple_to_code(rec["tag"])]}
-    return json.dumps(result)
+    return to_resource("Condition", rec)
 
 
 def to_observation(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "Observation"
-    if has(rec, "date"):
-        result["effectiveDateTime"] = rec["date"].isoformat()
-    if has(rec, "code"):
-        result["code"] = to_codeable_concept(rec["code"])
-    if has(rec, "subject"):
-        if has(rec, "subject_display"):
-            result["subject"] = {
-                "reference": "Patient/" + rec["subject"],
-                "display": rec["subject_display"],
-            }
-        else:
-            result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "value"):
-        value = rec["value"]
-        if isinstance(value, (int, float)):
-            result["valueQuantity"] = to_simple_quantity(rec["value"])
-        elif isinstance(value, tuple):
-            result["valueQuantity"] = to_simple_quantity(rec["value"])
-        elif isinstance(value, list):
-            result["valueCodeableConcept"] = to_codeable_concept(rec["value"])
-        elif isinstance(value, str):
-            result["valueString"] = value
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    if has(rec, "status"):
-        result["status"] = rec["status"]
-    return json.dumps(result)
+    return to_resource("Observation", rec)
 
 
 def to_med_dispense(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "MedicationDispense"
-    if has(rec, "date"):
-        result["whenHandedOver"] = rec["date"].isoformat()
-    if has(rec, "medication"):
-        result["medicationCodeableConcept"] = to_codeable_concept(rec["medication"])
-    if has(rec, "subject"):
-        result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "quantity"):
-        result["quantity"] = {"value": rec["quantity"]}
-    if has(rec, "daysSupply"):
-        result["daysSupply"] = {"value": rec["daysSupply"], "unit": "days"}
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    return json.dumps(result)
+    return to_resource("MedicationDispense", rec)
 
 
 def to_med_request(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "MedicationRequest"
-    if has(rec, "date"):
-        result["authoredOn"] = rec["date"].isoformat()
-    if has(rec, "medication"):
-        result["medicationCodeableConcept"] = to_codeable_concept(rec["medication"])
-    if has(rec, "subject"):
-        result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    if has(rec, "status"):
-        result["status"] = rec["status"]
-    return json.dumps(result)
+    return to_resource("MedicationRequest", rec)
 
 
 def to_med_statement(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "MedicationStatement"
-    if has(rec, "nct"):
-        result["extension"] = [
-            {
-                "url": "http://hl7.org/fhir/StructureDefinition/patient-clinicalTrial-NCT",
-                "valueString": rec["nct"],
-            }
-        ]
-    if has(rec, "subject"):
-        if has(rec, "subject_display"):
-            result["subject"] = {
-                "reference": "Patient/" + rec["subject"],
-                "display": str(rec["subject_display"]),
-            }
-        else:
-            result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "start_date"):
-        result["effectivePeriod"] = {}
-        result["effectivePeriod"].update({"start": rec["start_date"].isoformat()})
-    if has(rec, "end_date"):
-        result["effectivePeriod"].update({"end": rec["end_date"].isoformat()})
-    if has(rec, "medication"):
-        result["medicationCodeableConcept"] = to_codeable_concept(rec["medication"])
-    if has(rec, "status"):
-        result["status"] = rec["status"]
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    if has(rec, "indication"):
-        result["reasonCode"] = [to_codeable_concept(rec["indication"])]
-    if has(rec, "route"):
-        result["dosage"] = [{"route": to_codeable_concept(rec["route"])}]
-    if has(rec, "indication"):
-        result["reasonCode"] = [to_codeable_concept(rec["indication"])]
-    if has(rec, "route"):
-        result["dosage"] = [{"route": to_codeable_concept(rec["route"])}]
-    return json.dumps(result)
+    return to_resource("MedicationStatement", rec)
 
 
 def to_med_administration(rec):
-    result = {}
-    result["id"] = rec["id"]
-    result["resourceType"] = "MedicationAdministration"
-    if has(rec, "status"):
-        result["status"] = rec["status"]
-    if has(rec, "subject"):
-        result["subject"] = {"reference": "Patient/" + rec["subject"]}
-    if has(rec, "medication"):
-        result["medicationCodeableConcept"] = to_codeable_concept(rec["medication"])
-    if has(rec, "start_date"):
-        result["effectivePeriod"] = {}
-        result["effectivePeriod"].update({"start": rec["start_date"].isoformat()})
-    if has(rec, "end_date"):
-        result["effectivePeriod"].update({"end": rec["end_date"].isoformat()})
-    if has(rec, "note"):
-        result["note"] = [{"text": rec["note"]}]
-    dosage = to_dosage(rec)
-    if "doseAndRate" in dosage:
-        dosage.update(dosage.pop("doseAndRate")[0])
-    if "doseQuantity" in dosage:
-        dosage["dose"] = dosage.pop("doseQuantity")
-    result["dosage"] = dosage
-    return json.dumps(result)
+    return to_resource("MedicationAdministration", rec)
 
 
 types = {
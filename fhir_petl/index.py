@@ -0,0 +1,225 @@
+from hashlib import blake2b
+import math
+import os
+import pickle
+import re
+from petl.util.base import Table
+from fhir_petl.io import from_json, input_files, open_input
+
+
+# a materialized index from a subject key (e.g. SID) to the
+# exported patient id and a few extra fields. it is built
+# with a single pass over the patient table and joined by
+# subjectjoin without re-running the patient pipeline
+class SubjectIndex:
+    def __init__(self, table, key, subject="id", fields=()):
+        self.key = key
+        self.fields = tuple(fields)
+        self.lookup = {}
+        it = iter(table.cut(key, subject, *self.fields))
+        next(it, None)
+        for row in it:
+            if row[0] in self.lookup:
+                raise ValueError("duplicate subject key %r" % (row[0],))
+            self.lookup[row[0]] = tuple(row[1:])
+
+    def __len__(self):
+        return len(self.lookup)
+
+    def __contains__(self, key):
+        return key in self.lookup
+
+    def __getitem__(self, key):
+        return self.lookup[key]
+
+    def header(self):
+        return ("subject",) + self.fields
+
+    def subjects(self):
+        return (values[0] for values in self.lookup.values())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+# build a subject index, or load it from cache. the cache
+# is only used when it was built with the same key and
+# fields from the same source, the file (or files) the
+# patient table is read from, as it was then: same size
+# and modification time. patient ids are new on every
+# preprocess run, so a stale index would point every
+# resource at a patient that doesn't exist
+def subjectindex(table, key, subject="id", fields=(), cache=None, source=None):
+    if cache and source is None:
+        raise ValueError("a cached subject index needs the source of the table")
+    if cache:
+        expected = fingerprint(source, key, subject, fields)
+        if os.path.exists(cache):
+            index = SubjectIndex.load(cache)
+            if getattr(index, "fingerprint", None) == expected:
+                return index
+    index = SubjectIndex(table, key, subject, fields)
+    if cache:
+        index.fingerprint = expected
+        index.save(cache)
+    return index
+
+
+def fingerprint(source, key, subject, fields):
+    sources = [source] if isinstance(source, str) else list(source)
+    files = []
+    for path in sources:
+        stat = os.stat(path)
+        files.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return (key, subject, tuple(fields), tuple(files))
+
+
+# join a table to a subject index on lkey, like hashjoin
+# against the cut patient table: matching rows get the
+# subject and the extra fields of the index appended and
+# rows without a subject are dropped
+def subjectjoin(table, index, lkey):
+    return SubjectJoinView(table, index, lkey)
+
+
+Table.subjectjoin = subjectjoin
+
+
+class SubjectJoinView(Table):
+    def __init__(self, source, index, lkey):
+        self.source = source
+        self.index = index
+        self.lkey = lkey
+
+    def __iter__(self):
+        it = iter(self.source)
+        try:
+            header = next(it)
+        except StopIteration:
+            return
+        yield tuple(header) + self.index.header()
+        i = list(map(str, header)).index(self.lkey)
+        lookup = self.index.lookup
+        for row in it:
+            values = lookup.get(row[i])
+            if values is not None:
+                yield tuple(row) + values
+
+
+# a Bloom filter over byte strings: no false negatives and
+# about error false positives once capacity items are added
+class BloomFilter:
+    def __init__(self, capacity, error=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        digest = blake2b(item, digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little")
+        b = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(a + i * b) % size for i in range(self.hashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for position in self.positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self.positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+REFERENCE = re.compile(rb'"reference"\s*:\s*"Patient/([^"]*)"')
+
+
+# the ids of the exported Patients, from a Patient NDJSON
+# file (or shard manifest), a SubjectIndex or any iterable
+# of ids, as UTF-8 bytes. missing (None or empty) ids are
+# skipped
+def patient_ids(patients):
+    if isinstance(patients, str):
+        table = from_json(patients, ["id"], resourceType="Patient")
+        patients = (row[0] for row in table.data())
+    elif isinstance(patients, SubjectIndex):
+        patients = patients.subjects()
+    return (str(id).encode("utf8") for id in patients if id is not None and id != "")
+
+
+# the number of Patient ids, counted in a first pass over
+# a Patient file
+def count_ids(patients):
+    if isinstance(patients, str):
+        return sum(1 for id in patient_ids(patients))
+    if hasattr(patients, "__len__"):
+        return len(patients)
+    raise ValueError("a Bloom filter over an iterator of ids needs a capacity")
+
+
+# check that the Patient references of NDJSON files point to
+# exported Patients. the ids are kept in a set, or in a
+# Bloom filter of the given error rate with bloom, which may
+# miss a few dangling references but takes about 2 bytes per
+# Patient. the filter is sized for capacity ids, counted
+# first when it is not given, and the ids are added as they
+# stream. every file is streamed once; only the reference
+# values of each line are read
+class ReferenceChecker:
+    def __init__(self, patients, bloom=False, error=0.001, sample=20, capacity=None):
+        if bloom:
+            if capacity is None:
+                capacity = count_ids(patients)
+            self.ids = BloomFilter(capacity, error)
+            for id in patient_ids(patients):
+                self.ids.add(id)
+        else:
+            self.ids = set(patient_ids(patients))
+        self.sample = sample
+
+    def check(self, source):
+        ids = self.ids
+        resources = references = dangling = 0
+        samples = []
+        for path in input_files(source):
+            with open_input(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    resources += 1
+                    for id in REFERENCE.findall(line):
+                        references += 1
+                        if id not in ids:
+                            dangling += 1
+                            if len(samples) < self.sample:
+                                samples.append("Patient/" + id.decode("utf8"))
+        return {
+            "source": source,
+            "resources": resources,
+            "references": references,
+            "dangling": dangling,
+            "samples": samples,
+        }
+
+
+# check the references of every source and report the
+# counts per file
+def check_references(
+    patients, sources, bloom=False, error=0.001, sample=20, capacity=None
+):
+    checker = ReferenceChecker(patients, bloom, error, sample, capacity)
+    files = [checker.check(source) for source in sources]
+    return {
+        "dangling": sum(report["dangling"] for report in files),
+        "files": files,
+    }
@@ -0,0 +1,501 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import repeat
+from io import BufferedReader
+import bz2
+import gzip
+import json
+import os
+import re
+from petl.io.sources import read_source_from_arg, write_source_from_arg
+from petl.util.base import Table
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+extensions = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".zst": "zstd",
+}
+
+
+# guess the compression codec from a file name
+def codec_from_name(source):
+    if isinstance(source, str):
+        for extension, codec in extensions.items():
+            if source.endswith(extension):
+                return codec
+    return None
+
+
+# open a binary stream for writing to source, compressing
+# with the given codec (gzip, bz2 or zstd) as the bytes
+# are written. without a codec it is guessed from the file
+# name. threads > 1 compresses blocks of the output in
+# parallel: as independent gzip/bz2 members, or with the
+# multi-threaded zstd compressor. with an offset an
+# uncompressed file is truncated there and appended to
+@contextmanager
+def open_output(source, compression=None, level=None, threads=None, offset=None):
+    if compression is None:
+        compression = codec_from_name(source)
+    if compression not in (None, "gzip", "bz2", "zstd"):
+        raise ValueError("unknown compression %r" % compression)
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+    if offset is not None:
+        if compression is not None or not isinstance(source, str):
+            raise ValueError("only uncompressed files can be appended to")
+        raw = open(source, "r+b" if os.path.exists(source) else "wb")
+        raw.truncate(offset)
+        raw.seek(offset)
+    elif isinstance(source, str):
+        raw = open(source, "wb")
+    else:
+        raw = write_source_from_arg(source).open("wb")
+
+    with raw:
+        if compression is None:
+            yield raw
+        elif compression == "zstd":
+            compressor = zstandard.ZstdCompressor(
+                level=3 if level is None else level, threads=threads or 0
+            )
+            with compressor.stream_writer(raw, closefd=False) as f:
+                yield ZstdWriter(f)
+        elif threads and threads > 1:
+            if compression == "gzip":
+                compress = partial(
+                    gzip.compress, compresslevel=9 if level is None else level, mtime=0
+                )
+            else:
+                compress = partial(
+                    bz2.compress, compresslevel=9 if level is None else level
+                )
+            with BlockWriter(raw, compress, threads) as f:
+                yield f
+        elif compression == "gzip":
+            with gzip.GzipFile(
+                fileobj=raw, mode="wb", compresslevel=9 if level is None else level
+            ) as f:
+                yield f
+        else:
+            with bz2.BZ2File(
+                raw, "wb", compresslevel=9 if level is None else level
+            ) as f:
+                yield f
+
+
+# zstandard's stream writer doesn't implement writelines,
+# which the writers of to_json use
+class ZstdWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def writelines(self, lines):
+        self.stream.write(b"".join(lines))
+
+    def flush(self):
+        self.stream.flush()
+
+
+# a writer that collects the output into blocks and
+# compresses each block in a thread pool. the compressed
+# blocks are written in order; gzip and bz2 readers treat
+# the concatenation as a single stream
+class BlockWriter:
+    def __init__(self, raw, compress, threads, blocksize=1 << 20):
+        self.raw = raw
+        self.compress = compress
+        self.threads = threads
+        self.blocksize = blocksize
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            self.submit()
+        return len(data)
+
+    def writelines(self, lines):
+        lines = list(lines)
+        self.buffer.extend(lines)
+        self.size += sum(map(len, lines))
+        if self.size >= self.blocksize:
+            self.submit()
+
+    def submit(self):
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.pending.append(self.pool.submit(self.compress, block))
+        while len(self.pending) > 2 * self.threads:
+            self.raw.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buffer:
+            self.submit()
+        while self.pending:
+            self.raw.write(self.pending.popleft().result())
+        self.raw.flush()
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+
+
+# split a file name into the part before the shard number
+# and the extension after it, keeping a compression
+# extension with the one before it
+def split_name(source):
+    root, extension = os.path.splitext(source)
+    if extension in extensions:
+        root, inner = os.path.splitext(root)
+        extension = inner + extension
+    return root, extension
+
+
+# the progress of an export, saved to path every few rows:
+# the rows of the table that were written and the size of
+# the output after them. a new Checkpoint resumes from the
+# saved state, which has to be for the same output
+class Checkpoint:
+    def __init__(self, path, source, resourceType, every=100000):
+        self.path = path
+        self.every = every
+        self.state = {"source": source, "resourceType": resourceType}
+        self.rows = 0
+        self.bytes = 0
+        self.saved = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if any(state.get(k) != v for k, v in self.state.items()):
+                raise ValueError("%s is the checkpoint of another export" % path)
+            if not os.path.exists(source) or os.path.getsize(source) < state["bytes"]:
+                raise ValueError("%s is shorter than its checkpoint" % source)
+            self.rows = self.saved = state["rows"]
+            self.bytes = state["bytes"]
+
+    # count the rows of a chunk once its lines are written
+    # to output and save a checkpoint every so often
+    def update(self, output, rows):
+        self.rows += rows
+        if self.rows - self.saved >= self.every:
+            self.save(output)
+
+    def save(self, output):
+        output.flush()
+        os.fsync(output.fileno())
+        self.bytes = output.tell()
+        self.saved = self.rows
+        state = dict(self.state, rows=self.rows, bytes=self.bytes)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(state, f)
+        os.replace(temp, self.path)
+
+    # the export is complete
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# a writer that spreads lines over numbered shards, rolling
+# over to the next shard when the current one reaches the
+# record count or the size in bytes. sizes count the bytes
+# before compression. a line holds one record unless the
+# counts of its records are given, as they are for Bundles:
+# a shard then holds whole Bundles and at most records
+# resources (unless a single Bundle has more). on close a
+# manifest listing every shard with its record count is
+# written next to them
+class ShardWriter:
+    def __init__(
+        self,
+        source,
+        records=None,
+        size=None,
+        compression=None,
+        level=None,
+        threads=None,
+    ):
+        if not isinstance(source, str):
+            raise TypeError("sharded output needs a file name")
+        self.root, self.extension = split_name(source)
+        self.records = records
+        self.size = size
+        self.compression = compression or codec_from_name(source)
+        self.level = level
+        self.threads = threads
+        self.shards = []
+        self.output = None
+        self.file = None
+        self.count = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    # the manifest is only written when the export finished,
+    # so a failed export can't pass for a complete one
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.finish()
+
+    def path(self, number):
+        return "%s.%04d%s" % (self.root, number, self.extension)
+
+    def full(self, line, records):
+        if self.file is None:
+            return True
+        if self.records and self.count and self.count + records > self.records:
+            return True
+        return self.size and self.count and self.bytes + len(line) > self.size
+
+    def writelines(self, lines, counts=None):
+        batch = []
+        for line, records in zip(lines, counts or repeat(1)):
+            if self.full(line, records):
+                if batch:
+                    self.file.writelines(batch)
+                    batch = []
+                self.roll()
+            batch.append(line)
+            self.count += records
+            self.bytes += len(line)
+        if batch:
+            self.file.writelines(batch)
+
+    def write(self, line):
+        self.writelines([line])
+
+    def roll(self):
+        self.finish()
+        path = self.path(len(self.shards) + 1)
+        self.output = open_output(path, self.compression, self.level, self.threads)
+        self.file = self.output.__enter__()
+        self.shards.append({"file": os.path.basename(path)})
+
+    def finish(self):
+        if self.output is None:
+            return
+        self.output.__exit__(None, None, None)
+        self.shards[-1].update({"records": self.count, "bytes": self.bytes})
+        self.output = None
+        self.file = None
+        self.count = 0
+        self.bytes = 0
+
+    def close(self):
+        self.finish()
+        manifest = {
+            "records": sum(shard["records"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        with open(self.root + ".manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+# a writer that groups encoded Bundle entries into Bundles
+# of at most size entries, one Bundle per output line. the
+# entries are spliced into the Bundle text produced by the
+# same encoder, so only one Bundle is held at a time
+class BundleWriter:
+    def __init__(self, output, type, size, encode):
+        bundle = encode({"resourceType": "Bundle", "type": type, "entry": []})
+        self.prefix, self.suffix = bundle.rstrip(b"\n").split(b"[]")
+        self.separator = encode([0, 0]).rstrip(b"\n")[2:-2]
+        self.output = output
+        self.size = size
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.entries.append(line.rstrip(b"\n"))
+            if len(self.entries) >= self.size:
+                self.emit()
+
+    def write(self, line):
+        self.writelines([line])
+
+    # shards count the resources of each Bundle
+    def emit(self):
+        line = (
+            self.prefix
+            + b"["
+            + self.separator.join(self.entries)
+            + b"]"
+            + self.suffix
+            + b"\n"
+        )
+        if isinstance(self.output, ShardWriter):
+            self.output.writelines([line], [len(self.entries)])
+        else:
+            self.output.write(line)
+        self.entries = []
+
+    def close(self):
+        if self.entries:
+            self.emit()
+
+
+# open a binary stream for reading source, decompressing it
+# with the given codec or the one guessed from the name
+@contextmanager
+def open_input(source, compression=None):
+    if compression is None:
+        compression = codec_from_name(source)
+    if compression not in (None, "gzip", "bz2", "zstd"):
+        raise ValueError("unknown compression %r" % compression)
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+    if isinstance(source, str):
+        raw = open(source, "rb")
+    else:
+        raw = read_source_from_arg(source).open("rb")
+
+    with raw:
+        if compression is None:
+            yield raw
+        elif compression == "zstd":
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            with BufferedReader(reader) as f:
+                yield f
+        elif compression == "gzip":
+            with gzip.GzipFile(fileobj=raw, mode="rb") as f:
+                yield f
+        else:
+            with bz2.BZ2File(raw, "rb") as f:
+                yield f
+
+
+# read NDJSON resources as a table with one column per
+# path, like "id", "subject.reference" or
+# "code.coding[0].code"; missing values are None. lines are
+# only parsed as the table is iterated, and with
+# resourceType or ids (a name or a collection of them) the
+# lines that cannot match are skipped before parsing. a
+# shard manifest written by to_json reads all its shards
+def from_json(
+    source, paths=("resourceType", "id"), resourceType=None, ids=None, compression=None
+):
+    return NDJSONView(source, paths, resourceType, ids, compression)
+
+
+PATH = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+# split a path into dict keys and list indexes
+def compile_path(path):
+    steps = []
+    for key, index in PATH.findall(path):
+        steps.append(int(index) if index else key)
+    return tuple(steps)
+
+
+def get_path(resource, steps):
+    value = resource
+    for step in steps:
+        try:
+            value = value[step]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
+def as_set(values):
+    if values is None:
+        return None
+    if isinstance(values, str):
+        return frozenset((values,))
+    return frozenset(values)
+
+
+def input_files(source):
+    if isinstance(source, str) and source.endswith(".manifest.json"):
+        with open(source) as f:
+            manifest = json.load(f)
+        folder = os.path.dirname(source)
+        return [os.path.join(folder, shard["file"]) for shard in manifest["shards"]]
+    return [source]
+
+
+class NDJSONView(Table):
+    def __init__(self, source, paths, resourceType, ids, compression):
+        self.source = source
+        self.paths = tuple(paths)
+        self.resourceType = as_set(resourceType)
+        self.ids = as_set(ids)
+        self.compression = compression
+
+    def __iter__(self):
+        yield self.paths
+        steps = [compile_path(path) for path in self.paths]
+        loads = orjson.loads if orjson is not None else json.loads
+        types = self.resourceType
+        ids = self.ids
+        # ids and resource types never need escaping in JSON,
+        # so a line is only parsed when one of its "id" or
+        # "resourceType" values is wanted
+        prefilters = []
+        for name, values in (("resourceType", types), ("id", ids)):
+            if values is not None:
+                pattern = re.compile(rb'"%s"\s*:\s*"([^"]*)"' % name.encode())
+                prefilters.append((pattern, {v.encode() for v in values}))
+        for path in input_files(self.source):
+            with open_input(path, self.compression) as f:
+                for line in f:
+                    if prefilters and not all(
+                        not wanted.isdisjoint(pattern.findall(line))
+                        for pattern, wanted in prefilters
+                    ):
+                        continue
+                    if not line.strip():
+                        continue
+                    resource = loads(line)
+                    if types is not None and resource.get("resourceType") not in types:
+                        continue
+                    if ids is not None and resource.get("id") not in ids:
+                        continue
+                    yield tuple(get_path(resource, s) for s in steps)
@@ -0,0 +1,139 @@
+from time import perf_counter
+import json
+from petl.util.base import Table
+
+
+# the counters of a stage of a run: calls, rows in and out,
+# bytes written and the time spent in the stage, with and
+# without the time of the stages it pulls from
+class Stage:
+    def __init__(self):
+        self.calls = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+
+    def report(self):
+        report = {
+            "calls": self.calls,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 6),
+            "self_seconds": round(self.self_seconds, 6),
+        }
+        if self.rows_out and self.seconds:
+            report["rows_per_second"] = round(self.rows_out / self.seconds, 1)
+        return report
+
+
+# collects the timings of a run by stage: tables wrapped
+# with table (source parsing, joins, fieldmaps), functions
+# wrapped with mapper (fieldmap mappers) and the build,
+# encode and write stages of to_json(..., profile=...).
+# nothing is timed unless a Profile is passed in, so a run
+# without one costs nothing extra
+class Profile:
+    def __init__(self):
+        self.stages = {}
+        self.frames = []
+        self.start = perf_counter()
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    # add the counters measured elsewhere, e.g. in a worker
+    def add(self, name, seconds=0.0, rows_in=0, rows_out=0, bytes=0, calls=1):
+        stage = self.stage(name)
+        stage.calls += calls
+        stage.rows_in += rows_in
+        stage.rows_out += rows_out
+        stage.bytes += bytes
+        stage.seconds += seconds
+        stage.self_seconds += seconds
+
+    def merge(self, timings):
+        for name, values in timings.items():
+            self.add(name, **values)
+
+    def table(self, table, name):
+        return ProfiledView(table, self, name)
+
+    def mapper(self, name, fn):
+        stage = self.stage(name)
+        frames = self.frames
+
+        def mapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                stage.calls += 1
+                stage.seconds += elapsed
+                stage.self_seconds += elapsed
+                if frames:
+                    frames[-1][0] += elapsed
+
+        return mapper
+
+    def report(self):
+        return {
+            "seconds": round(perf_counter() - self.start, 6),
+            "stages": {name: stage.report() for name, stage in self.stages.items()},
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+END = object()
+
+
+# a table counting the rows it passes on and the time spent
+# pulling them from its source. the time and rows of the
+# profiled stages and mappers it pulls from are kept in a
+# frame, so the stage also knows its own time and rows in
+class ProfiledView(Table):
+    def __init__(self, source, profile, name):
+        self.source = source
+        self.profile = profile
+        self.name = name
+
+    def __iter__(self):
+        stage = self.profile.stage(self.name)
+        frames = self.profile.frames
+        stage.calls += 1
+        it = iter(self.source)
+        header = True
+        while True:
+            frame = [0.0, 0]
+            frames.append(frame)
+            start = perf_counter()
+            try:
+                row = next(it)
+            except StopIteration:
+                row = END
+            finally:
+                elapsed = perf_counter() - start
+                frames.pop()
+            stage.seconds += elapsed
+            stage.self_seconds += elapsed - frame[0]
+            stage.rows_in += frame[1]
+            if frames:
+                frames[-1][0] += elapsed
+            if row is END:
+                return
+            if header:
+                header = False
+            else:
+                stage.rows_out += 1
+                if frames:
+                    frames[-1][1] += 1
+            yield row
@@ -0,0 +1,89 @@
+from contextlib import ExitStack
+from fhir_petl.fhir import get_encoder, open_ndjson, plans, resources, to_entry
+from fhir_petl.util import chunks
+
+
+# build the resources of a mapped table once and feed them
+# to every sink, in chunks of resource dicts. instead of a
+# table that would re-run the pipeline, this returns the
+# number of resources and the summary each sink returns
+# when it is closed. sinks that are context managers are
+# exited with the error when the export fails
+def tee(table, resourceType, sinks, chunksize=1000):
+    if resourceType not in plans:
+        raise KeyError(resourceType)
+    count = 0
+    with ExitStack() as stack:
+        for sink in sinks:
+            if hasattr(sink, "__exit__"):
+                stack.push(sink)
+            else:
+                stack.callback(sink.close)
+        for chunk in chunks(resources(table, resourceType), chunksize):
+            count += len(chunk)
+            for sink in sinks:
+                sink.send(chunk)
+    return {
+        "resources": count,
+        "sinks": [sink.summary() for sink in sinks],
+    }
+
+
+# a sink writing NDJSON like to_json, taking the same
+# encoder and output options
+class NDJSONSink:
+    def __init__(self, source, encoder="json", bundle=None, **options):
+        self.source = source
+        self.encode = get_encoder(encoder)
+        self.bundle = bundle
+        self.stack = ExitStack()
+        self.output = self.stack.enter_context(
+            open_ndjson(source, encoder, bundle=bundle, **options)
+        )
+        self.resources = 0
+        self.bytes = 0
+
+    def send(self, resources):
+        if self.bundle:
+            resources = map(to_entry, resources)
+        lines = list(map(self.encode, resources))
+        self.output.writelines(lines)
+        self.resources += len(lines)
+        self.bytes += sum(map(len, lines))
+
+    def close(self):
+        self.stack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self.stack.__exit__(*exc)
+
+    def summary(self):
+        return {
+            "source": self.source,
+            "resources": self.resources,
+            "bytes": self.bytes,
+        }
+
+
+# a sink counting the resources and how many of them have
+# each top level element
+class StatsSink:
+    def __init__(self):
+        self.resources = 0
+        self.elements = {}
+
+    def send(self, resources):
+        elements = self.elements
+        for resource in resources:
+            for key in resource:
+                elements[key] = elements.get(key, 0) + 1
+        self.resources += len(resources)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return {"resources": self.resources, "elements": dict(self.elements)}
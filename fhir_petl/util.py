@@ -1,24 +1,129 @@
-from datetime import datetime
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime, timedelta
 from enum import Enum
-from uuid import uuid4
+from functools import lru_cache, partial
+from itertools import chain, islice
+from operator import itemgetter
+from uuid import NAMESPACE_URL, UUID, uuid4, uuid5
+import gzip
+import heapq
+import json
 import os
+import pickle
+import re
+import shutil
 import sys
+import tempfile
 import petl as etl
+from petl.comparison import Comparable
+from petl.util.base import Table
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 # Parse a string using input_format into
 # a datetime and use the output_format to
-# render the datetime as a string
-def dateparser(input_format, output_format):
+# render the datetime as a string. formats
+# made of fixed width numbers (%Y, %y, %m,
+# %d, %H, %M, %S) and literals are parsed by
+# slicing, anything else by strptime. the
+# last cache distinct texts are memoized
+def dateparser(input_format, output_format, cache=4096):
+    strptime = compile_strptime(input_format)
+
+    def build(text):
+        return FormattedDateTime(strptime(text), output_format)
+
+    cached = lru_cache(maxsize=cache)(build) if cache else build
+
     def parse(text):
         if text:
-            dt = datetime.strptime(text, input_format)
-            return FormattedDateTime(dt, output_format)
+            if type(text) is str:
+                return cached(text)
+            return build(text)
 
         return None
 
     return parse
 
 
+# the width of the fixed width directives
+# handled without strptime
+widths = {"Y": 4, "y": 2, "m": 2, "d": 2, "H": 2, "M": 2, "S": 2}
+
+
+# a function parsing text like strptime with
+# the given format. texts the fast path does
+# not match exactly (single digit fields, other
+# spacing, out of range values, ...) are left
+# to strptime, so the results and the errors
+# are the ones of strptime
+def compile_strptime(input_format):
+    fields = []
+    literals = []
+    position = 0
+    i = 0
+    while i < len(input_format):
+        char = input_format[i]
+        if char == "%":
+            directive = input_format[i + 1 : i + 2]
+            if directive == "%":
+                literals.append((position, "%"))
+                position += 1
+            elif directive in widths:
+                fields.append((directive, position, position + widths[directive]))
+                position += widths[directive]
+            else:
+                return partial(slow_strptime, input_format)
+            i += 2
+        else:
+            literals.append((position, char))
+            position += 1
+            i += 1
+    length = position
+    names = [name for name, start, end in fields]
+    if len(set(names)) != len(names) or ("Y" in names and "y" in names):
+        return partial(slow_strptime, input_format)
+
+    slots = {"Y": 0, "y": 0, "m": 1, "d": 2, "H": 3, "M": 4, "S": 5}
+    fields = [(slots[name], start, end) for name, start, end in fields]
+    short_year = "y" in names
+    limits = (9999, 12, 31, 23, 59, 59)
+
+    def strptime(text):
+        if type(text) is not str or len(text) != length or not text.isascii():
+            return slow_strptime(input_format, text)
+        for at, char in literals:
+            if text[at] != char:
+                return slow_strptime(input_format, text)
+        values = [1900, 1, 1, 0, 0, 0]
+        for slot, start, end in fields:
+            digits = text[start:end]
+            if not digits.isdigit():
+                return slow_strptime(input_format, text)
+            value = int(digits)
+            if value > limits[slot] or (slot in (1, 2) and not value):
+                return slow_strptime(input_format, text)
+            values[slot] = value
+        if short_year:
+            values[0] += 2000 if values[0] <= 68 else 1900
+        try:
+            return datetime(*values)
+        except ValueError:
+            return slow_strptime(input_format, text)
+
+    return strptime
+
+
+def slow_strptime(input_format, text):
+    return datetime.strptime(text, input_format)
+
+
 class FormattedDateTime:
     def __init__(self, dt, output_format):
         if not isinstance(output_format, ISOFormat):
@@ -51,6 +156,155 @@ class ISOFormat(Enum):
 # parse a year string
 year = dateparser("%Y", ISOFormat.YEAR)
 
+
+# an ISO date string, as rendered by shiftdates. like a
+# FormattedDateTime it has an isoformat method, so it can
+# be used for any date field of a plan
+class ISODate(str):
+    def isoformat(self):
+        return str(self)
+
+
+# numpy units of the ISO formats
+datetime64_units = {
+    ISOFormat.YEAR: "Y",
+    ISOFormat.MONTH: "M",
+    ISOFormat.DAY: "D",
+    ISOFormat.MINUTE: "m",
+    ISOFormat.SECOND: "s",
+}
+
+
+# add a field to a table with the dates of the base field
+# shifted by the days in the offset field (or the sum of
+# several offset fields) times scale, rendered at the
+# precision of output_format. e.g. the visit date from the
+# index date and DAYS_VIS_INDEX, or a birth date from a
+# sample date and an age in years with scale=-365.25. the
+# dates are computed in batches, with numpy datetime64
+# arrays when numpy is installed. base values may be
+# FormattedDateTime, date or datetime values, or strings
+# parsed with input_format (ISO 8601 without one). rows
+# missing a base or an offset get None
+def shiftdates(
+    table,
+    field,
+    base,
+    offset,
+    output_format=ISOFormat.DAY,
+    scale=1,
+    input_format=None,
+    batch=65536,
+):
+    return ShiftDatesView(
+        table, field, base, offset, output_format, scale, input_format, batch
+    )
+
+
+Table.shiftdates = shiftdates
+
+
+class ShiftDatesView(Table):
+    def __init__(
+        self, source, field, base, offset, output_format, scale, input_format, batch
+    ):
+        self.source = source
+        self.field = field
+        self.base = base
+        self.offsets = [offset] if isinstance(offset, str) else list(offset)
+        self.output_format = output_format
+        self.scale = scale
+        self.parse = (
+            dateparser(input_format, ISOFormat.SECOND) if input_format else None
+        )
+        self.batch = batch
+
+    def __iter__(self):
+        it = iter(self.source)
+        try:
+            header = tuple(next(it))
+        except StopIteration:
+            return
+        fields = list(map(str, header))
+        yield header + (self.field,)
+        base = fields.index(self.base)
+        offsets = [fields.index(offset) for offset in self.offsets]
+        for rows in chunks(it, self.batch):
+            bases = [to_datetime(row[base], self.parse) for row in rows]
+            days = [sum_days([row[i] for i in offsets]) for row in rows]
+            dates = shift_dates(bases, days, self.scale, self.output_format)
+            for row, shifted in zip(rows, dates):
+                yield tuple(row) + (shifted,)
+
+
+def to_datetime(value, parse=None):
+    if not value:
+        return None
+    if isinstance(value, FormattedDateTime):
+        return to_datetime(value.dt)
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if parse:
+        return parse(value).dt
+    return datetime.fromisoformat(value)
+
+
+# the sum of the offsets of a row, None when one is missing
+def sum_days(values):
+    total = 0
+    for value in values:
+        if value is None or value == "":
+            return None
+        if isinstance(value, str):
+            try:
+                value = int(value)
+            except ValueError:
+                value = float(value)
+        total += value
+    return total
+
+
+# shift datetimes by days times scale and render them at
+# the precision of output_format
+def shift_dates(bases, days, scale, output_format):
+    if np is not None:
+        return shift_datetime64(bases, days, scale, output_format)
+    results = []
+    memo = {}
+    for dt, offset in zip(bases, days):
+        if dt is None or offset is None:
+            results.append(None)
+            continue
+        key = (dt, offset)
+        result = memo.get(key)
+        if result is None:
+            shifted = dt + timedelta(days=offset * scale)
+            result = memo[key] = ISODate(shifted.strftime(output_format.value))
+        results.append(result)
+    return results
+
+
+def shift_datetime64(bases, days, scale, output_format):
+    missing = np.array(
+        [dt is None or offset is None for dt, offset in zip(bases, days)], dtype=bool
+    )
+    base = np.array(
+        [None if dt is None else dt.replace(tzinfo=None) for dt in bases],
+        dtype="datetime64[us]",
+    )
+    offset = np.array(
+        [0 if offset is None else offset for offset in days], dtype=np.float64
+    )
+    micros = np.round(offset * (scale * 86400 * 10**6)).astype(np.int64)
+    shifted = base + micros.astype("timedelta64[us]")
+    texts = np.datetime_as_string(shifted, unit=datetime64_units[output_format])
+    return [
+        None if skip else ISODate(text) for skip, text in zip(missing.tolist(), texts)
+    ]
+
+
 # join one are more inputs into a string
 # separated by space. falsy arguments are
 # ignored
@@ -62,7 +316,138 @@ def join(*args):
     return result.strip()
 
 
-number = etl.numparser()
+# characters int never accepts: a text with one of them
+# is a float, a complex number (1e3, nan, inf, 1j) or not
+# a number at all, so parsing it starts with float
+NOT_INT = re.compile("[.eEnNiIjJ]")
+
+# the null tokens of extracts: blanks and spreadsheet errors.
+# the default of the column parsers (numbertype, numbers,
+# convertnumbers); number itself keeps etl.numparser's
+# behaviour and has no null tokens
+NULLS = frozenset(("", "NA", "N/A", "NULL", "#N/A", "#VALUE!", "#DIV/0!"))
+
+
+# like etl.numparser: int, then float, then complex, and
+# the value as it is (or the error when strict) when none
+# of them parse it. texts in nulls are None. int is only
+# tried on texts that can be ints and up to cache distinct
+# texts are memoized (a plain dict, cleared when full, is
+# cheaper on misses than an lru_cache); other values are
+# parsed exactly like etl.numparser
+def numberparser(nulls=(), cache=65536, strict=False):
+    nulls = frozenset(nulls)
+    search = NOT_INT.search
+    slow = etl.numparser(strict)
+
+    def build(text):
+        if text in nulls:
+            return None
+        if not search(text):
+            try:
+                return int(text)
+            except ValueError:
+                pass
+        try:
+            return float(text)
+        except ValueError:
+            pass
+        try:
+            return complex(text)
+        except ValueError:
+            if strict:
+                raise
+        return text
+
+    memo = {}
+
+    def parse(value):
+        if type(value) is not str:
+            return slow(value)
+        if not cache:
+            return build(value)
+        result = memo.get(value, memo)
+        if result is memo:
+            if len(memo) >= cache:
+                memo.clear()
+            result = memo[value] = build(value)
+        return result
+
+    return parse
+
+
+number = numberparser()
+
+
+# the type of a column of numbers from a sample of its
+# values: int when every value that is not null is an int,
+# float when they are ints or floats, otherwise None
+def numbertype(values, nulls=NULLS):
+    parse = numberparser(nulls, cache=0)
+    kind = int
+    for value in values:
+        value = parse(value)
+        if value is None or type(value) is int:
+            continue
+        if type(value) is float:
+            kind = float
+        else:
+            return None
+    return kind
+
+
+# parse a whole column of numbers like numberparser. when
+# a sample of the values says the column is ints it is
+# parsed with int in one pass, going back to parsing value
+# by value if a later value is not an int
+def numbers(values, nulls=NULLS, sample=1024, strict=False):
+    values = values if isinstance(values, list) else list(values)
+    nulls = frozenset(nulls)
+    if numbertype(islice(values, sample), nulls) is int:
+        try:
+            if nulls:
+                return [None if value in nulls else int(value) for value in values]
+            return list(map(int, values))
+        except (TypeError, ValueError):
+            pass
+    return list(map(numberparser(nulls, strict=strict), values))
+
+
+# parse the numbers of the given fields in batches of rows
+# with numbers, e.g. table.convertnumbers("RESULT", "AGE",
+# nulls=NULLS | {"-9"})
+def convertnumbers(table, *fields, nulls=NULLS, batch=65536):
+    return NumbersView(table, fields, nulls, batch)
+
+
+Table.convertnumbers = convertnumbers
+
+
+class NumbersView(Table):
+    def __init__(self, source, fields, nulls, batch):
+        self.source = source
+        self.fields = fields
+        self.nulls = frozenset(nulls)
+        self.batch = batch
+
+    def __iter__(self):
+        it = iter(self.source)
+        try:
+            header = tuple(next(it))
+        except StopIteration:
+            return
+        yield header
+        fields = list(map(str, header))
+        indexes = [fields.index(field) for field in self.fields]
+        for rows in chunks(it, self.batch):
+            rows = [list(row) for row in rows]
+            for i in indexes:
+                column = numbers([row[i] for row in rows], self.nulls)
+                for row, value in zip(rows, column):
+                    row[i] = value
+            for row in rows:
+                yield tuple(row)
+
 
 # recursively make directories
 def mkdirp(path):
@@ -77,16 +462,345 @@ def resolve(path):
     return "{0}/{1}".format(root, path)
 
 
-# preprocess a table to get it ready for ETL
-def preprocess(table, sort=None, ids=None, convert=int):
+# the default namespace of key derived ids
+ID_NAMESPACE = uuid5(NAMESPACE_URL, "https://github.com/lifeomic/fhir-petl")
+
+
+# preprocess a table to get it ready for ETL. ids are random
+# (uuid4) unless key names the field or fields of a natural
+# key, e.g. ["SID", "CODE", "DATE"]; then they are uuid5 ids
+# derived from the key and the namespace (a UUID or any
+# string), so a rerun over the same data gives the same ids.
+# the sort holds about memory bytes of rows, spilling the
+# rest to compressed runs under tempdir (see externalsort)
+def preprocess(
+    table,
+    sort=None,
+    ids=None,
+    convert=int,
+    key=None,
+    namespace=None,
+    memory=256 * 2**20,
+    tempdir=None,
+    workers=None,
+):
     if not ids:
         ids = ["ID"]
 
-    for id in ids:
-        table = table.addfield(id, lambda rec: uuid4())
+    if key:
+        table = KeyedIdView(table, ids, key, namespace)
+    else:
+        for id in ids:
+            table = table.addfield(id, lambda rec: uuid4())
     if sort:
         if convert:
             table = table.convert(sort, convert)
-        table = table.sort(sort, buffersize=1000000)
+        table = table.externalsort(sort, memory, tempdir, workers)
 
     return table
+
+
+# a table with id fields derived from a natural key. two
+# rows with the same key would get the same ids, so the
+# keys are checked in a pass over the source before the
+# first row is yielded, and a duplicate raises a ValueError
+# without any output. to keep the check small and fast only
+# the 8 byte hash of the key values is kept per row, in 256
+# arrays split by its last byte; when two of them are equal
+# the source is scanned again to tell a duplicate key from
+# a collision of the digests
+class KeyedIdView(Table):
+    def __init__(self, source, ids, key, namespace=None):
+        self.source = source
+        self.ids = list(ids)
+        self.key = [key] if isinstance(key, str) else list(key)
+        if namespace is None:
+            namespace = ID_NAMESPACE
+        elif not isinstance(namespace, UUID):
+            namespace = uuid5(NAMESPACE_URL, namespace)
+        self.namespace = namespace
+
+    def __iter__(self):
+        self.check()
+        it = iter(self.source)
+        try:
+            header = tuple(next(it))
+        except StopIteration:
+            return
+        yield header + tuple(self.ids)
+        indexes = self.indexes(header)
+        namespace = self.namespace
+        for row in it:
+            name = key_name(row, indexes)
+            yield tuple(row) + tuple(uuid5(namespace, id + name) for id in self.ids)
+
+    def indexes(self, header):
+        fields = list(map(str, header))
+        return [fields.index(field) for field in self.key]
+
+    def check(self):
+        buckets = [array("Q") for _ in range(256)]
+        for value in self.digests():
+            buckets[value & 255].append(value & DIGEST)
+        collisions = set()
+        for n, bucket in enumerate(buckets):
+            bucket = sorted(bucket)
+            collisions.update(
+                (n, a) for a, b in zip(bucket, islice(bucket, 1, None)) if a == b
+            )
+        if not collisions:
+            return
+        names = set()
+        for name, value in self.digests(names=True):
+            if (value & 255, value & DIGEST) in collisions:
+                if name in names:
+                    raise ValueError("duplicate key %s = %s" % (self.key, name))
+                names.add(name)
+
+    # the hash of the key values of each row, with the key
+    # name when names is set. the hashes only have to agree
+    # within this process, so the builtin hash will do
+    def digests(self, names=False):
+        it = iter(self.source)
+        try:
+            indexes = self.indexes(next(it))
+        except StopIteration:
+            return
+        for row in it:
+            values = tuple(None if row[i] is None else str(row[i]) for i in indexes)
+            value = hash(values) & DIGEST
+            yield (key_name(row, indexes), value) if names else value
+
+
+DIGEST = 2**64 - 1
+
+
+def key_name(row, indexes):
+    return json.dumps([None if row[i] is None else str(row[i]) for i in indexes])
+
+
+# sort a table by the key field (or fields) holding about
+# memory bytes of rows at a time. the rows are sorted in
+# runs that are spilled to gzipped pickle files in a
+# temporary directory under tempdir, and the runs are
+# merged fanin at a time. with workers the runs are sorted
+# and written by a pool of processes, each holding a share
+# of the memory. like petl's sort the order is stable
+def externalsort(table, key, memory=256 * 2**20, tempdir=None, workers=None, fanin=64):
+    return ExternalSortView(table, key, memory, tempdir, workers, fanin)
+
+
+Table.externalsort = externalsort
+
+
+class ExternalSortView(Table):
+    def __init__(self, source, key, memory, tempdir, workers, fanin):
+        self.source = source
+        self.key = [key] if isinstance(key, str) else list(key)
+        self.memory = memory
+        self.tempdir = tempdir
+        self.workers = workers
+        self.fanin = fanin
+
+    def __iter__(self):
+        it = iter(self.source)
+        try:
+            header = tuple(next(it))
+        except StopIteration:
+            return
+        yield header
+        fields = list(map(str, header))
+        indexes = [fields.index(field) for field in self.key]
+        budget = self.memory
+        if self.workers:
+            budget //= 2 * self.workers + 1
+        rows = fill(it, budget)
+        following = next(it, END)
+        if following is END:
+            yield from sort_rows(rows, indexes)[0]
+            return
+        folder = tempfile.mkdtemp(prefix="fhir-petl-sort-", dir=self.tempdir)
+        try:
+            buffers = chain([rows], spill(chain([following], it), budget))
+            rows = None
+            tasks = (
+                (buffer, indexes, os.path.join(folder, "run%06d" % n))
+                for n, buffer in enumerate(buffers)
+            )
+            if self.workers:
+                runs = list(parallel(write_run, tasks, self.workers))
+            else:
+                runs = [write_run(*task) for task in tasks]
+            kinds = merge_types([kinds for path, kinds in runs])
+            getkey = itemgetter(*indexes) if kinds is not None else SortKey(indexes)
+            runs = [path for path, _ in runs]
+            while len(runs) > self.fanin:
+                runs = [
+                    write_rows(
+                        heapq.merge(*map(read_run, group), key=getkey),
+                        os.path.join(folder, "merge%06d-%d" % (n, len(runs))),
+                    )
+                    for n, group in enumerate(chunks(runs, self.fanin))
+                ]
+            yield from heapq.merge(*map(read_run, runs), key=getkey)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+END = object()
+
+
+# read rows until they take about budget bytes. the size
+# of every 16th row is measured
+def fill(it, budget):
+    rows = []
+    size = 0
+    for row in it:
+        rows.append(row)
+        if len(rows) % 16 == 1:
+            size += 16 * (sys.getsizeof(row) + sum(map(sys.getsizeof, row)))
+            if size >= budget:
+                break
+    return rows
+
+
+def spill(it, budget):
+    rows = fill(it, budget)
+    while rows:
+        yield rows
+        rows = fill(it, budget)
+
+
+# sort rows by the fields at indexes like petl's sort and
+# return them with the types of their key values. the
+# plain values are tried first; they order like petl's
+# Comparable when every key field holds only numbers, only
+# str or only bytes. otherwise (None, mixed types, short
+# rows) the rows are sorted again from their original
+# order with Comparable keys and the types are None
+def sort_rows(rows, indexes):
+    try:
+        ordered = sorted(rows, key=itemgetter(*indexes))
+    except (TypeError, IndexError):
+        pass
+    else:
+        kinds = key_types(ordered, indexes)
+        if native(kinds):
+            return ordered, kinds
+    return sorted(rows, key=SortKey(indexes)), None
+
+
+NUMBERS = frozenset((int, float, bool))
+
+
+def key_types(rows, indexes):
+    return [frozenset(map(type, map(itemgetter(i), rows))) for i in indexes]
+
+
+def native(kinds):
+    return all(
+        types <= NUMBERS or types == {str} or types == {bytes} for types in kinds
+    )
+
+
+# the key types of runs merged together, or None when
+# their plain values can't be merged like petl's sort
+def merge_types(runs):
+    if None in runs:
+        return None
+    kinds = [frozenset().union(*types) for types in zip(*runs)]
+    return kinds if native(kinds) else None
+
+
+# the sort key of petl's sort (comparable_itemgetter) as
+# a class, so it can be pickled for the workers
+class SortKey:
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.getter = itemgetter(*indexes)
+
+    def __call__(self, row):
+        try:
+            return Comparable(self.getter(row))
+        except IndexError:
+            values = tuple(row[i] if i < len(row) else None for i in self.indexes)
+            return Comparable(values if len(values) > 1 else values[0])
+
+
+# sort a run of rows by the fields at indexes and write it
+# to path. returns the path and the types of the keys
+def write_run(rows, indexes, path):
+    rows, kinds = sort_rows(rows, indexes)
+    return write_rows(rows, path), kinds
+
+
+# write rows to path, pickled in batches
+def write_rows(rows, path):
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        for batch in chunks(rows, 1024):
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_run(path):
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+# split an iterable into lists of at most size items
+def chunks(iterable, size):
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+
+# call fn(*args) for each tuple of args in a pool of
+# worker processes and yield the results, in the order
+# of tasks or as they complete. only a few tasks per
+# worker are in flight so the input is read lazily
+def parallel(fn, tasks, workers, ordered=True):
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for args in tasks:
+            pending.append(pool.submit(fn, *args))
+            if len(pending) < 2 * workers:
+                continue
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, rest = wait(pending, return_when=FIRST_COMPLETED)
+                pending = deque(rest)
+                for future in done:
+                    yield future.result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# read-only dict and list for values shared through a
+# cache, where changing one would corrupt the others.
+# copy.deepcopy and pickle give back a plain dict or list
+def read_only(*args, **kwargs):
+    raise TypeError("cached values are read-only, copy them to make changes")
+
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = read_only
+    append = extend = insert = pop = remove = reverse = sort = clear = read_only
+
+    def __reduce__(self):
+        return (list, (list(self),))
@@ -0,0 +1,479 @@
+from functools import lru_cache
+import re
+from fhir_petl.util import FrozenDict, FrozenList
+
+# structural checks for the resources built by fhir_petl.fhir.
+# each check takes a value and returns None when it is valid
+# or a short message saying what is wrong with it. the rules
+# cover the elements the builders can write: their types,
+# the elements each resource requires and the precision of
+# dates and times
+
+FROZEN = frozenset((FrozenDict, FrozenList))
+
+ID = re.compile(r"[A-Za-z0-9\-\.]{1,64}")
+DATE = re.compile(r"[0-9]{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12][0-9]|3[01]))?)?")
+DATE_TIME = re.compile(
+    r"[0-9]{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12][0-9]|3[01])"
+    r"(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?"
+    r"(Z|[+-]((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))?)?)?"
+)
+
+
+def check_id(x):
+    if not isinstance(x, str) or not ID.fullmatch(x):
+        return "not a valid id"
+    return None
+
+
+def check_string(x):
+    if not isinstance(x, str) or not x:
+        return "not a non-empty string"
+    return None
+
+
+def check_code(x):
+    if not isinstance(x, str) or not x or x != x.strip():
+        return "not a valid code"
+    return None
+
+
+def check_decimal(x):
+    if isinstance(x, bool) or not isinstance(x, (int, float)):
+        return "not a number"
+    return None
+
+
+def check_boolean(x):
+    if not isinstance(x, bool):
+        return "not a boolean"
+    return None
+
+
+def check_positive_int(x):
+    if isinstance(x, bool) or not isinstance(x, int) or x < 1:
+        return "not a positive integer"
+    return None
+
+
+# dates repeat a lot, so the matches are cached
+def check_date(x):
+    if not isinstance(x, str) or not match_date(x):
+        return "not a date (YYYY, YYYY-MM or YYYY-MM-DD)"
+    return None
+
+
+# times need seconds and a time zone
+def check_date_time(x):
+    if not isinstance(x, str) or not match_date_time(x):
+        return "not a dateTime with a valid precision"
+    return None
+
+
+@lru_cache(maxsize=65536)
+def match_date(x):
+    return DATE.fullmatch(x) is not None
+
+
+@lru_cache(maxsize=65536)
+def match_date_time(x):
+    return DATE_TIME.fullmatch(x) is not None
+
+
+def one_of(*values):
+    values = frozenset(values)
+
+    def check(x):
+        if x not in values:
+            return "not one of " + ", ".join(sorted(values))
+        return None
+
+    return check
+
+
+def list_of(check_item):
+    def check(x):
+        if not isinstance(x, list) or not x:
+            return "not a non-empty list"
+        for item in x:
+            message = check_item(item)
+            if message:
+                return message
+        return None
+
+    return check
+
+
+# a complex type: a dict with known elements, some of them
+# required, and at least one element set. valid string and
+# number elements are passed without calling their checks
+def complex_type(name, elements, required=()):
+    strings = frozenset(k for k, c in elements.items() if c is check_string)
+    numbers = frozenset(k for k, c in elements.items() if c is check_decimal)
+
+    def check(x):
+        if not isinstance(x, dict) or not x:
+            return "not a non-empty " + name
+        for key in required:
+            if key not in x:
+                return name + "." + key + " is missing"
+        for key, value in x.items():
+            kind = type(value)
+            if kind is str:
+                if value and key in strings:
+                    continue
+            elif kind is float or kind is int:
+                if key in numbers:
+                    continue
+            check_element = elements.get(key)
+            if check_element is None:
+                return name + "." + key + " is not an element"
+            message = check_element(value)
+            if message:
+                return name + "." + key + " " + message
+        return None
+
+    return check
+
+
+check_coding = complex_type(
+    "Coding",
+    {"system": check_string, "code": check_code, "display": check_string},
+)
+
+check_codeable_concept = complex_type(
+    "CodeableConcept",
+    {"coding": list_of(check_coding), "text": check_string},
+)
+
+check_reference = complex_type(
+    "Reference",
+    {"reference": check_string, "display": check_string},
+    ("reference",),
+)
+
+check_quantity = complex_type(
+    "Quantity",
+    {
+        "value": check_decimal,
+        "comparator": one_of("<", "<=", ">=", ">"),
+        "unit": check_string,
+        "system": check_string,
+        "code": check_code,
+    },
+    ("value",),
+)
+
+check_ratio = complex_type(
+    "Ratio", {"numerator": check_quantity, "denominator": check_quantity}
+)
+
+check_range = complex_type("Range", {"low": check_quantity, "high": check_quantity})
+
+check_period = complex_type(
+    "Period", {"start": check_date_time, "end": check_date_time}
+)
+
+check_annotation = complex_type("Annotation", {"text": check_string}, ("text",))
+
+check_identifier = complex_type(
+    "Identifier",
+    {
+        "type": check_codeable_concept,
+        "system": check_string,
+        "value": check_string,
+    },
+    ("value",),
+)
+
+check_extension = complex_type(
+    "Extension",
+    {
+        "url": check_string,
+        "valueString": check_string,
+        "valueCodeableConcept": check_codeable_concept,
+    },
+    ("url",),
+)
+
+check_meta = complex_type("Meta", {"tag": list_of(check_coding)})
+
+check_timing = complex_type(
+    "Timing", {"event": check_string, "code": check_codeable_concept}
+)
+
+dosage_elements = {
+    "sequence": check_positive_int,
+    "text": check_string,
+    "additionalInstruction": check_codeable_concept,
+    "patientInstruction": check_string,
+    "timing": check_timing,
+    "asNeededBoolean": check_boolean,
+    "asNeededCodeableConcept": check_codeable_concept,
+    "site": check_codeable_concept,
+    "route": check_codeable_concept,
+    "method": check_codeable_concept,
+    "doseAndRate": list_of(
+        complex_type(
+            "Dosage.doseAndRate",
+            {
+                "type": check_codeable_concept,
+                "doseRange": check_range,
+                "doseQuantity": check_quantity,
+                "rateRatio": check_ratio,
+                "rateRange": check_range,
+                "rateQuantity": check_quantity,
+            },
+        )
+    ),
+    "maxDosePerPeriod": check_ratio,
+    "maxDosePerAdministration": check_quantity,
+    "maxDosePerLifetime": check_quantity,
+}
+
+check_dosage = complex_type("Dosage", dosage_elements)
+
+# MedicationAdministration.dosage has the dose and rate
+# inline and may be empty when no dosage fields are mapped
+administration_dosage_elements = {
+    "text": check_string,
+    "site": check_codeable_concept,
+    "route": check_codeable_concept,
+    "method": check_codeable_concept,
+    "dose": check_quantity,
+    "rateRatio": check_ratio,
+    "rateQuantity": check_quantity,
+}
+
+
+check_inline_dosage = complex_type("Dosage", administration_dosage_elements)
+
+
+def check_administration_dosage(x):
+    if x == {}:
+        return None
+    return check_inline_dosage(x)
+
+
+common = {
+    "id": check_id,
+    "meta": check_meta,
+    "extension": list_of(check_extension),
+    "identifier": list_of(check_identifier),
+    "subject": check_reference,
+    "note": list_of(check_annotation),
+}
+
+# (elements, required elements) by resource type
+rules = {
+    "Patient": (
+        {
+            "maritalStatus": check_codeable_concept,
+            "gender": one_of("male", "female", "other", "unknown"),
+            "birthDate": check_date,
+            "deceasedDateTime": check_date_time,
+        },
+        (),
+    ),
+    "Procedure": (
+        {
+            "status": check_code,
+            "performedDateTime": check_date_time,
+            "code": check_codeable_concept,
+        },
+        ("subject",),
+    ),
+    "Condition": (
+        {
+            "onsetDateTime": check_date_time,
+            "assertedDate": check_date_time,
+            "code": check_codeable_concept,
+            "bodySite": list_of(check_codeable_concept),
+            "severity": check_codeable_concept,
+        },
+        ("subject",),
+    ),
+    "Observation": (
+        {
+            "status": one_of(
+                "registered",
+                "preliminary",
+                "final",
+                "amended",
+                "corrected",
+                "cancelled",
+                "entered-in-error",
+                "unknown",
+            ),
+            "effectiveDateTime": check_date_time,
+            "code": check_codeable_concept,
+            "valueQuantity": check_quantity,
+            "valueCodeableConcept": check_codeable_concept,
+            "valueString": check_string,
+        },
+        ("status", "code"),
+    ),
+    "MedicationDispense": (
+        {
+            "whenHandedOver": check_date_time,
+            "medicationCodeableConcept": check_codeable_concept,
+            "quantity": check_quantity,
+            "daysSupply": check_quantity,
+        },
+        ("medicationCodeableConcept",),
+    ),
+    "MedicationRequest": (
+        {
+            "status": check_code,
+            "authoredOn": check_date_time,
+            "medicationCodeableConcept": check_codeable_concept,
+        },
+        ("status", "subject", "medicationCodeableConcept"),
+    ),
+    "MedicationStatement": (
+        {
+            "status": check_code,
+            "effectivePeriod": check_period,
+            "medicationCodeableConcept": check_codeable_concept,
+            "reasonCode": list_of(check_codeable_concept),
+            "dosage": list_of(check_dosage),
+        },
+        ("status", "subject", "medicationCodeableConcept"),
+    ),
+    "MedicationAdministration": (
+        {
+            "status": check_code,
+            "effectivePeriod": check_period,
+            "medicationCodeableConcept": check_codeable_concept,
+            "dosage": check_administration_dosage,
+        },
+        ("status", "subject", "medicationCodeableConcept", "effectivePeriod"),
+    ),
+}
+
+
+# the checks of a resource type by element, and its
+# required elements
+@lru_cache(maxsize=None)
+def compile_rules(resourceType):
+    elements, required = rules[resourceType]
+    checks = dict(common)
+    checks.update(elements)
+    checks["resourceType"] = one_of(resourceType)
+    return checks, ("id", "resourceType") + required
+
+
+# validates batches of resources of one type, counting the
+# errors by rule ("<type>.<element>: <message>") and keeping
+# the first sample errors with the resource id. with a rate
+# below 1 only about that share of the resources is checked
+# (every n-th one), for exports where checking all of them
+# costs too much. a Validator can also be used as a sink for
+# fhir_petl.sinks.tee
+class Validator:
+    def __init__(self, resourceType, sample=20, rate=1.0):
+        if not 0 < rate <= 1:
+            raise ValueError("rate must be in (0, 1]")
+        self.resourceType = resourceType
+        self.checks, required = compile_rules(resourceType)
+        self.required = frozenset(required)
+        self.sample = sample
+        self.rate = rate
+        self.step = max(int(round(1 / rate)), 1)
+        self.offset = 0
+        self.resources = 0
+        self.checked = 0
+        self.invalid = 0
+        self.errors = {}
+        self.samples = []
+        self.valid = {}
+
+    # the fast pass only finds the invalid resources; their
+    # errors are collected by check_resource. values shared
+    # through the code caches are checked once
+    def check(self, resources):
+        checks = self.checks
+        required = self.required
+        valid = self.valid
+        selected = resources
+        if self.step > 1:
+            selected = resources[self.offset :: self.step]
+            self.offset = (self.offset - len(resources)) % self.step
+        for resource in selected:
+            failed = not resource.keys() >= required
+            for key, value in resource.items():
+                check = checks.get(key)
+                if check is None:
+                    failed = True
+                elif type(value) in FROZEN:
+                    entry = valid.get(id(value))
+                    if entry is not None and entry[0] is value and entry[1] is check:
+                        continue
+                    if check(value):
+                        failed = True
+                    else:
+                        if len(valid) >= 65536:
+                            valid.clear()
+                        valid[id(value)] = (value, check)
+                elif check(value):
+                    failed = True
+            if failed:
+                self.record(resource)
+        self.resources += len(resources)
+        self.checked += len(selected)
+
+    def record(self, resource):
+        errors = self.check_resource(resource)
+        if not errors:
+            return
+        self.invalid += 1
+        for rule in errors:
+            self.errors[rule] = self.errors.get(rule, 0) + 1
+            if len(self.samples) < self.sample:
+                self.samples.append({"id": resource.get("id"), "rule": rule})
+
+    def check_resource(self, resource):
+        errors = []
+        prefix = self.resourceType + "."
+        for key in self.required:
+            if key not in resource:
+                errors.append(prefix + key + ": is missing")
+        for key, value in resource.items():
+            check = self.checks.get(key)
+            if check is None:
+                errors.append(prefix + key + ": is not an element")
+                continue
+            message = check(value)
+            if message:
+                errors.append(prefix + key + ": " + message)
+        return errors
+
+    # add the counts of another validator's report, as
+    # returned by the workers of to_json
+    def merge(self, report):
+        self.resources += report["resources"]
+        self.checked += report["checked"]
+        self.invalid += report["invalid"]
+        for rule, count in report["errors"].items():
+            self.errors[rule] = self.errors.get(rule, 0) + count
+        room = self.sample - len(self.samples)
+        self.samples.extend(report["samples"][: max(room, 0)])
+
+    def report(self):
+        return {
+            "resourceType": self.resourceType,
+            "resources": self.resources,
+            "checked": self.checked,
+            "invalid": self.invalid,
+            "errors": dict(self.errors),
+            "samples": list(self.samples),
+        }
+
+    def send(self, resources):
+        self.check(resources)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return self.report()
@@ -0,0 +1,54 @@
+import petl as etl
+import pytest
+from fhir_petl import sinks
+from fhir_petl.arrow import ParquetSink, flat, from_arrow, from_parquet, to_parquet
+
+def test_from_parquet(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    target = str(tmpdir.join('labs.parquet'))
+    pq.write_table(pa.table({'STUDYID': ['1', '2', '3', '2'], 'CODE': ['a', 'b', 'c', 'd'], 'VALUE': [1, 2, 3, 4]}),
+                   target, row_group_size=2)
+    table = from_parquet(target).selectin('STUDYID', {'2', '3'}).cut('STUDYID', 'CODE')
+    assert table.columns == ('STUDYID', 'CODE')
+    assert list(table) == [('STUDYID', 'CODE'), ('2', 'b'), ('3', 'c'), ('2', 'd')]
+    assert list(from_parquet(target, ['CODE', 'VALUE']).selecteq('VALUE', 4).cut('CODE')) == [('CODE',), ('d',)]
+    with pytest.raises(etl.errors.FieldSelectionError):
+        list(from_parquet(target).cut('CODE').selectin('STUDYID', {'2'}))
+
+def test_from_arrow(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.feather as feather
+    target = str(tmpdir.join('labs.arrow'))
+    feather.write_feather(pa.table({'STUDYID': ['1', '2'], 'CODE': ['a', 'b']}), target)
+    assert list(from_arrow(target).selecteq('STUDYID', '2')) == [('STUDYID', 'CODE'), ('2', 'b')]
+
+observations = etl.wrap([['id', 'subject', 'status', 'code', 'value'],
+                         ['1', 'p1', 'final', ('http://loinc.org', '1234-5', 'Test'), (1, 'mg', 'http://unitsofmeasure.org', 'mg')],
+                         ['2', 'p2', 'final', None, 'high']])
+
+def test_flat():
+    table = flat(observations, 'Observation').cut('id', 'subject', 'code_code', 'value_quantity', 'value_unit', 'value_string')
+    assert list(table) == [('id', 'subject', 'code_code', 'value_quantity', 'value_unit', 'value_string'),
+                           ('1', 'Patient/p1', '1234-5', 1.0, 'mg', None),
+                           ('2', 'Patient/p2', None, None, None, 'high')]
+
+def test_to_parquet(tmpdir):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    target = str(tmpdir.join('Observation.parquet'))
+    to_parquet(observations, 'Observation', target, row_group_size=1)
+    result = pq.read_table(target)
+    assert result.num_rows == 2
+    assert pq.ParquetFile(target).metadata.num_row_groups == 2
+    assert result.column('code_code').to_pylist() == ['1234-5', None]
+
+def test_parquet_sink(tmpdir):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    target = str(tmpdir.join('Observation.parquet'))
+    table = etl.wrap([['id', 'subject', 'status']] + [[str(i), 'p1', 'final'] for i in range(5)])
+    summary = sinks.tee(table, 'Observation', [ParquetSink(target, 'Observation', row_group_size=2)], chunksize=3)
+    assert summary['sinks'] == [{'source': target, 'resources': 5, 'row_groups': 3}]
+    assert pq.read_table(target).column('id').to_pylist() == ['0', '1', '2', '3', '4']
+    assert pq.ParquetFile(target).metadata.num_row_groups == 3
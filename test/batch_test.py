@@ -0,0 +1,29 @@
+import json
+import petl as etl
+import pytest
+from fhir_petl.batch import Job, run_batch, main
+
+def write(tmpdir):
+    etl.wrap([['STUDYID', 'NAME']] + [[str(i % 4), 'n%d' % i] for i in range(10)]).tocsv(str(tmpdir.join('demog.csv')))
+    etl.wrap([['STUDYID', 'CODE']] + [[str(i % 3), 'c%d' % i] for i in range(6)]).totsv(str(tmpdir.join('dx.txt')))
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_batch(tmpdir, workers):
+    write(tmpdir)
+    jobs = [Job(str(tmpdir.join('demog.csv')), str(tmpdir.join('Patient.csv')), 'STUDYID', filter=('STUDYID', ['1', '2'])),
+            Job(str(tmpdir.join('dx.txt')), str(tmpdir.join('Condition.csv')), 'STUDYID')]
+    reports = run_batch(jobs, workers)
+    assert [report['output'] for report in reports] == [job.output for job in jobs]
+    assert [(report['rows_read'], report['rows_written']) for report in reports] == [(10, 5), (6, 6)]
+    patients = etl.fromcsv(str(tmpdir.join('Patient.csv')))
+    assert patients.header() == ('STUDYID', 'NAME', 'ID')
+    assert list(patients.values('STUDYID')) == ['1', '1', '1', '2', '2']
+    assert etl.fromcsv(str(tmpdir.join('Condition.csv'))).header() == ('STUDYID', 'CODE', 'ID')
+
+def test_main(tmpdir, capsys):
+    write(tmpdir)
+    with open(str(tmpdir.join('jobs.json')), 'w') as f:
+        json.dump([{'input': 'dx.txt', 'output': 'Condition.csv', 'sort': 'STUDYID'}], f)
+    main([str(tmpdir.join('jobs.json')), '--root', str(tmpdir), '--workers', '1'])
+    report = json.loads(capsys.readouterr().out)
+    assert report['jobs'][0]['rows_written'] == 6
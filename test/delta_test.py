@@ -0,0 +1,38 @@
+import json
+import petl as etl
+from fhir_petl.delta import Delta, HashManifest, canonical, digests
+from fhir_petl.fhir import canonical_encoder, resources, to_json
+
+def export(tmpdir, rows, previous):
+    target = str(tmpdir.join('Patient.json'))
+    delta = Delta(previous)
+    to_json(etl.wrap([['id', 'gender']] + rows), 'Patient', target, delta=delta)
+    delta.save(previous)
+    with open(target) as f:
+        return [json.loads(line)['id'] for line in f], delta
+
+def test_delta(tmpdir):
+    manifest = str(tmpdir.join('Patient.hashes'))
+    written, delta = export(tmpdir, [['1', 'male'], ['2', 'female'], ['3', 'male']], manifest)
+    assert written == ['1', '2', '3']
+    assert delta.summary() == {'new': 3, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+    assert len(HashManifest.load(manifest)) == 3
+    written, delta = export(tmpdir, [['3', 'male'], ['2', 'male'], ['4', 'female']], manifest)
+    assert written == ['2', '4']
+    assert delta.summary() == {'new': 1, 'changed': 1, 'unchanged': 1, 'deleted': 1}
+    assert delta.tombstones() == ['Patient/1']
+
+def test_canonical_encoder():
+    table = etl.wrap([['id', 'status', 'code', 'subject']] + [[str(i), 'final', ('http://loinc.org', '1234-5'), 'p1'] for i in range(3)])
+    for resource in resources(table, 'Observation'):
+        assert canonical_encoder()(resource) == canonical(resource)
+
+def test_delta_digests(tmpdir):
+    table = etl.wrap([['id', 'status', 'code', 'subject']] + [[str(i), 'final', ('http://loinc.org', '1234-5'), 'p1'] for i in range(3)])
+    manifest = str(tmpdir.join('Observation.hashes'))
+    delta = Delta()
+    to_json(table, 'Observation', str(tmpdir.join('Observation.json')), delta=delta)
+    delta.save(manifest)
+    saved = HashManifest.load(manifest)
+    expected = sorted((key, content) for name, key, content in digests(resources(table, 'Observation')))
+    assert list(zip(saved.keys, saved.hashes)) == expected
@@ -1,6 +1,9 @@
+import copy
 from datetime import date
+import gzip
 import json
 import petl as etl
+import pytest
 import fhir_petl.fhir as fhir
 
 def test_to_ratio():
@@ -73,3 +76,164 @@ def test_to_med_administration():
                                                           'system': 'http://unitsofmeasure.org', 'code': 'mg'},
                                             'denominator': {'value': 24, 'comparator': '>', 'unit': 'h',
                                                             'system': 'http://unitsofmeasure.org', 'code': 'h'}}
+
+def test_to_patient():
+    header = ['id', 'race', 'ethnicity', 'gender']
+    data = ['1', ('http://hl7.org/fhir/v3/Race', '2028-9', 'Asian'), ('http://hl7.org/fhir/v3/Ethnicity', '2186-5'), 'female']
+    patient = json.loads(fhir.to_patient(etl.util.base.Record(data, header)))
+    assert list(patient) == ['id', 'resourceType', 'extension', 'gender']
+    assert [e['url'] for e in patient['extension']] == ['http://hl7.org/fhir/StructureDefinition/us-core-ethnicity',
+                                                        'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race']
+
+def test_compile_plan():
+    build = fhir.compile_plan('Observation', ('id', 'code', 'subject', 'status'))
+    observation = build(('1', ('http://loinc.org', '1234-5'), None, 'final'))
+    assert observation == {'id': '1', 'resourceType': 'Observation',
+                           'code': {'coding': [{'system': 'http://loinc.org', 'code': '1234-5'}]}, 'status': 'final'}
+
+def test_to_json(tmpdir):
+    table = etl.wrap([['id', 'subject', 'note'], ['1', 'a', 'first'], ['2', 'b', None]])
+    target = str(tmpdir.join('Procedure.json'))
+    fhir.to_json(table, 'Procedure', target)
+    with open(target) as f:
+        lines = f.read().splitlines()
+    assert lines == [
+        json.dumps({'id': '1', 'resourceType': 'Procedure', 'subject': {'reference': 'Patient/a'}, 'note': [{'text': 'first'}]}),
+        json.dumps({'id': '2', 'resourceType': 'Procedure', 'subject': {'reference': 'Patient/b'}})
+    ]
+
+def test_to_json_orjson(tmpdir):
+    pytest.importorskip('orjson')
+    table = etl.wrap([['id', 'subject', 'note'], ['1', 'a', 'café'], ['2', 'b', None]])
+    expected = str(tmpdir.join('expected.json'))
+    target = str(tmpdir.join('Procedure.json'))
+    fhir.to_json(table, 'Procedure', expected)
+    fhir.to_json(table, 'Procedure', target, encoder='orjson')
+    with open(expected) as e, open(target, encoding='utf8') as t:
+        assert [json.loads(line) for line in e] == [json.loads(line) for line in t]
+
+def test_to_json_workers(tmpdir):
+    table = etl.wrap([['id', 'subject', 'status']] + [[str(i), 'p%d' % i, 'final'] for i in range(50)])
+    expected = str(tmpdir.join('expected.json'))
+    ordered = str(tmpdir.join('ordered.json'))
+    unordered = str(tmpdir.join('unordered.json'))
+    fhir.to_json(table, 'Observation', expected)
+    fhir.to_json(table, 'Observation', ordered, workers=2, chunksize=7)
+    fhir.to_json(table, 'Observation', unordered, workers=2, chunksize=7, ordered=False)
+    with open(expected) as e, open(ordered) as o, open(unordered) as u:
+        lines = e.readlines()
+        assert o.readlines() == lines
+        assert sorted(u.readlines()) == sorted(lines)
+
+def test_to_json_gzip(tmpdir):
+    table = etl.wrap([['id', 'status'], ['1', 'final'], ['2', 'final']])
+    target = str(tmpdir.join('Observation.json.gz'))
+    fhir.to_json(table, 'Observation', target)
+    with gzip.open(target, 'rt') as f:
+        assert [json.loads(line)['id'] for line in f] == ['1', '2']
+
+def test_to_json_zstd(tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    table = etl.wrap([['id', 'status'], ['1', 'final'], ['2', 'final']])
+    target = str(tmpdir.join('Observation.json.zst'))
+    fhir.to_json(table, 'Observation', target)
+    with open(target, 'rb') as f:
+        lines = zstandard.ZstdDecompressor().stream_reader(f).read().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == ['1', '2']
+
+def test_to_json_shards(tmpdir):
+    table = etl.wrap([['id', 'status']] + [[str(i), 'final'] for i in range(5)])
+    fhir.to_json(table, 'Observation', str(tmpdir.join('Observation.ndjson.gz')), shard_records=2)
+    with gzip.open(str(tmpdir.join('Observation.0003.ndjson.gz')), 'rt') as f:
+        assert [json.loads(line)['id'] for line in f] == ['4']
+    assert sorted(tmpdir.listdir(lambda p: 'Observation' in p.basename)) == sorted(
+        [tmpdir.join('Observation.000%d.ndjson.gz' % n) for n in (1, 2, 3)] + [tmpdir.join('Observation.manifest.json')])
+
+def test_to_json_shards_bundle(tmpdir):
+    table = etl.wrap([['id', 'status']] + [[str(i), 'final'] for i in range(7)])
+    fhir.to_json(table, 'Observation', str(tmpdir.join('Observation.ndjson')), shard_records=4, bundle='batch', bundle_size=2)
+    with open(str(tmpdir.join('Observation.manifest.json'))) as f:
+        manifest = json.load(f)
+    assert manifest['records'] == 7
+    assert [shard['records'] for shard in manifest['shards']] == [4, 3]
+
+def test_to_json_columns(tmpdir):
+    table = etl.wrap([['id', 'date', 'code', 'value', 'subject', 'status']] + [
+        [str(i), date(2020, 1, 1 + i % 3), ('http://loinc.org', '1234-5'), ['high', 'low', None, (1.5, 'mg', 'http://unitsofmeasure.org', 'mg')][i % 4], 'p%d' % (i % 2), 'final']
+        for i in range(10)])
+    rows = str(tmpdir.join('rows.json'))
+    columns = str(tmpdir.join('columns.json'))
+    fhir.to_json(table, 'Observation', rows)
+    fhir.to_json(table, 'Observation', columns, engine='columns', chunksize=4)
+    with open(rows, 'rb') as a, open(columns, 'rb') as b:
+        assert a.read() == b.read()
+    with pytest.raises(ValueError):
+        fhir.to_json(table, 'Observation', columns, engine='columns', bundle='batch')
+
+def test_to_json_checkpoint(tmpdir, monkeypatch):
+    rows = [['id', 'status']] + [[str(i), 'final'] for i in range(10)]
+    target = str(tmpdir.join('Observation.json'))
+    checkpoint = str(tmpdir.join('Observation.checkpoint'))
+
+    def crash(row):
+        if row == '7':
+            raise RuntimeError('crash')
+        return row
+    with pytest.raises(RuntimeError):
+        fhir.to_json(etl.wrap(rows).convert('id', crash, failonerror=True), 'Observation', target,
+                     chunksize=2, checkpoint=checkpoint, checkpoint_rows=2)
+    with open(checkpoint) as f:
+        assert json.load(f)['rows'] == 6
+
+    built = []
+    pad = fhir.pad
+    monkeypatch.setattr(fhir, 'pad', lambda row, width: built.append(row[0]) or pad(row, width))
+    fhir.to_json(etl.wrap(rows), 'Observation', target,
+                 chunksize=2, checkpoint=checkpoint, checkpoint_rows=2)
+    with open(target) as f:
+        assert [json.loads(line)['id'] for line in f] == [str(i) for i in range(10)]
+    assert built == ['6', '7', '8', '9']
+    assert not tmpdir.join('Observation.checkpoint').exists()
+
+def test_to_json_bundle(tmpdir):
+    table = etl.wrap([['id', 'status'], ['1', 'final'], ['2', 'final'], ['3', 'final']])
+    target = str(tmpdir.join('Observation.json'))
+    fhir.to_json(table, 'Observation', target, bundle='transaction', bundle_size=2)
+    with open(target) as f:
+        lines = f.read().splitlines()
+    observations = [{'id': id, 'resourceType': 'Observation', 'status': 'final'} for id in ('1', '2', '3')]
+    entries = [{'fullUrl': 'urn:uuid:' + o['id'], 'resource': o,
+                'request': {'method': 'PUT', 'url': 'Observation/' + o['id']}} for o in observations]
+    assert lines == [
+        json.dumps({'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries[:2]}),
+        json.dumps({'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries[2:]})
+    ]
+
+def test_to_codeable_concept_cache():
+    fhir.code_cache_clear()
+    race = ('http://hl7.org/fhir/v3/Race', '2028-9', 'Asian')
+    first = fhir.to_codeable_concept(race)
+    assert fhir.to_codeable_concept(race) is first
+    assert fhir.to_codeable_concept([race]) == first
+    assert fhir.code_cache_info()['to_codeable_concept'].hits == 1
+    with pytest.raises(TypeError):
+        first['coding'].append({'code': 'x'})
+    with pytest.raises(TypeError):
+        first['coding'][0]['code'] = 'x'
+    assert copy.deepcopy(first) == {'coding': [{'system': 'http://hl7.org/fhir/v3/Race', 'code': '2028-9', 'display': 'Asian'}]}
+    assert fhir.to_codeable_concept(('s', ['unhashable'])) == {'coding': [{'system': 's', 'code': ['unhashable']}]}
+
+def test_code_cache_types():
+    fhir.to_codeable_concept(('http://loinc.org', 1))
+    assert json.dumps(fhir.to_codeable_concept(('http://loinc.org', 1.0))) == '{"coding": [{"system": "http://loinc.org", "code": 1.0}]}'
+    fhir.to_subject('p1', 1)
+    assert json.dumps(fhir.to_subject('p1', True)) == '{"reference": "Patient/p1", "display": true}'
+
+def test_fragment_encoder():
+    race = ('http://hl7.org/fhir/v3/Race', '2028-9', 'Asian')
+    build = fhir.compile_plan('Patient', ('id', 'subject_id', 'race', 'gender', 'tag'))
+    encode = fhir.fragment_encoder('json')
+    for row in [('1', 'S1', race, 'female', None), ('2', 'S2', race, None, ('cohort', 'A')), ('3', None, None, None, None)]:
+        patient = build(row)
+        assert encode(patient) == fhir.encode_json(patient)
+        assert encode(fhir.to_entry(patient)) == fhir.encode_json(fhir.to_entry(patient))
@@ -0,0 +1,62 @@
+import petl as etl
+import pytest
+from fhir_petl.fhir import to_json
+from fhir_petl.index import BloomFilter, SubjectIndex, check_references, patient_ids, subjectindex
+
+def test_subjectjoin(tmpdir):
+    patients = etl.wrap([['id', 'SID', 'index_date'], ['p1', 'A', 1990], ['p2', 'B', 1991]])
+    index = subjectindex(patients, 'SID', fields=['index_date'])
+    assert len(index) == 2
+    table = etl.wrap([['ID', 'SID'], ['1', 'B'], ['2', 'C'], ['3', 'A']])
+    joined = table.subjectjoin(index, 'SID')
+    assert list(joined) == [('ID', 'SID', 'subject', 'index_date'), ('1', 'B', 'p2', 1991), ('3', 'A', 'p1', 1990)]
+
+def test_subjectindex_cache(tmpdir):
+    source = str(tmpdir.join('Patient.csv'))
+    cache = str(tmpdir.join('index.pickle'))
+    etl.wrap([['id', 'SID'], ['p1', 'A']]).tocsv(source)
+    index = subjectindex(etl.fromcsv(source), 'SID', cache=cache, source=source)
+    assert SubjectIndex.load(cache).lookup == index.lookup == {'A': ('p1',)}
+    assert subjectindex(etl.wrap([['id', 'SID']]), 'SID', cache=cache, source=source).lookup == index.lookup
+    etl.wrap([['id', 'SID'], ['p10', 'A']]).tocsv(source)
+    assert subjectindex(etl.fromcsv(source), 'SID', cache=cache, source=source).lookup == {'A': ('p10',)}
+    with pytest.raises(ValueError):
+        subjectindex(etl.fromcsv(source), 'SID', cache=cache)
+
+def test_subject_index_duplicate():
+    patients = etl.wrap([['id', 'SID'], ['p1', 'A'], ['p2', 'A']])
+    with pytest.raises(ValueError):
+        SubjectIndex(patients, 'SID')
+
+@pytest.mark.parametrize('bloom', [False, True])
+def test_check_references(tmpdir, bloom):
+    patients = str(tmpdir.join('Patient.json'))
+    observations = str(tmpdir.join('Observation.json.gz'))
+    to_json(etl.wrap([['id'], ['p1'], ['p2']]), 'Patient', patients)
+    to_json(etl.wrap([['id', 'status', 'subject'], ['1', 'final', 'p1'], ['2', 'final', 'p3'], ['3', 'final', 'p2']]),
+            'Observation', observations)
+    report = check_references(patients, [observations], bloom=bloom)
+    assert report['dangling'] == 1
+    assert report['files'][0]['resources'] == 3
+    assert report['files'][0]['references'] == 3
+    assert report['files'][0]['samples'] == ['Patient/p3']
+
+def test_check_references_capacity(tmpdir):
+    observations = str(tmpdir.join('Observation.json'))
+    to_json(etl.wrap([['id', 'status', 'subject'], ['1', 'final', 'p1'], ['2', 'final', 'p3']]), 'Observation', observations)
+    assert check_references(iter(['p1', 'p2']), [observations], bloom=True, capacity=2)['dangling'] == 1
+    with pytest.raises(ValueError):
+        check_references(iter(['p1', 'p2']), [observations], bloom=True)
+
+def test_patient_ids_missing(tmpdir):
+    patients = tmpdir.join('Patient.json')
+    patients.write('{"resourceType": "Patient", "id": "p1"}\n{"resourceType": "Patient"}\n')
+    assert list(patient_ids(str(patients))) == [b'p1']
+    assert list(patient_ids(['p1', None, '', 2])) == [b'p1', b'2']
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(b'%d' % i)
+    assert all(b'%d' % i in bloom for i in range(1000))
+    assert sum(b'x%d' % i in bloom for i in range(10000)) < 300
@@ -0,0 +1,72 @@
+import bz2
+import gzip
+import json
+import pytest
+import fhir_petl.io as io
+
+def read_lines(path, compression):
+    opener = {'gzip': gzip.open, 'bz2': bz2.open}[compression]
+    with opener(path) as f:
+        return f.read().splitlines()
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2'])
+def test_open_output(tmpdir, compression):
+    lines = [b'{"id": "%d"}\n' % i for i in range(1000)]
+    single = str(tmpdir.join('single'))
+    blocks = str(tmpdir.join('blocks'))
+    with io.open_output(single, compression) as f:
+        f.writelines(lines)
+    with io.open_output(blocks, compression, level=1, threads=2) as f:
+        f.blocksize = 1024
+        f.writelines(lines)
+    expected = [line.rstrip() for line in lines]
+    assert read_lines(single, compression) == expected
+    assert read_lines(blocks, compression) == expected
+
+def test_open_output_zstd(tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    target = str(tmpdir.join('out.json.zst'))
+    with io.open_output(target) as f:
+        f.write(b'{"id": "1"}\n')
+    with open(target, 'rb') as f:
+        assert zstandard.ZstdDecompressor().stream_reader(f).read() == b'{"id": "1"}\n'
+
+def test_codec_from_name():
+    assert io.codec_from_name('Observation.json.gz') == 'gzip'
+    assert io.codec_from_name('Observation.json') is None
+
+def test_shard_writer(tmpdir):
+    lines = [b'{"id": "%d"}\n' % i for i in range(10)]
+    with io.ShardWriter(str(tmpdir.join('Patient.ndjson')), size=40) as f:
+        f.writelines(lines)
+    assert f.close()['records'] == 10
+    with open(str(tmpdir.join('Patient.manifest.json'))) as m:
+        manifest = json.load(m)
+    assert [shard['records'] for shard in manifest['shards']] == [3, 3, 3, 1]
+    with open(str(tmpdir.join('Patient.0004.ndjson')), 'rb') as s:
+        assert s.read() == b'{"id": "9"}\n'
+
+def test_shard_writer_error(tmpdir):
+    with pytest.raises(RuntimeError):
+        with io.ShardWriter(str(tmpdir.join('Patient.ndjson')), records=1) as f:
+            f.write(b'{"id": "1"}\n')
+            raise RuntimeError('failed')
+    assert tmpdir.join('Patient.0001.ndjson').read() == '{"id": "1"}\n'
+    assert not tmpdir.join('Patient.manifest.json').exists()
+
+def test_from_json(tmpdir):
+    target = str(tmpdir.join('fhir.json.gz'))
+    resources = [
+        {'resourceType': 'Patient', 'id': 'p1'},
+        {'resourceType': 'Observation', 'id': 'o1', 'subject': {'reference': 'Patient/p1'},
+         'code': {'coding': [{'code': '1234-5'}]}},
+        {'resourceType': 'Observation', 'id': 'o2', 'subject': {'reference': 'Patient/p1'}},
+    ]
+    with io.open_output(target) as f:
+        f.writelines(json.dumps(r).encode() + b'\n' for r in resources)
+    table = io.from_json(target, ['id', 'subject.reference', 'code.coding[0].code'],
+                         resourceType='Observation')
+    assert list(table) == [('id', 'subject.reference', 'code.coding[0].code'),
+                           ('o1', 'Patient/p1', '1234-5'), ('o2', 'Patient/p1', None)]
+    assert list(io.from_json(target, ids=['p1', 'o2'])) == [
+        ('resourceType', 'id'), ('Patient', 'p1'), ('Observation', 'o2')]
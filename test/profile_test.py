@@ -0,0 +1,23 @@
+import json
+import petl as etl
+from fhir_petl.fhir import to_json
+from fhir_petl.profile import Profile
+
+def test_profile(tmpdir):
+    profile = Profile()
+    source = profile.table(etl.wrap([['ID', 'STATUS']] + [[str(i), 'final'] for i in range(10)]), 'source')
+    table = profile.table(source.fieldmap({'id': 'ID', 'status': ('STATUS', profile.mapper('status', str.upper))})
+                          .selectne('id', '3'), 'map')
+    to_json(table, 'Observation', str(tmpdir.join('Observation.json')), chunksize=4, profile=profile)
+    profile.save(str(tmpdir.join('profile.json')))
+    with open(str(tmpdir.join('profile.json'))) as f:
+        stages = json.load(f)['stages']
+    assert stages['source']['rows_out'] == 10
+    assert stages['map']['rows_in'] == 10
+    assert stages['map']['rows_out'] == 9
+    assert stages['status']['calls'] == 10
+    assert stages['build']['rows_out'] == 9
+    assert stages['build.status']['calls'] == 9
+    assert stages['encode']['rows_out'] == 9
+    assert stages['write']['bytes'] == tmpdir.join('Observation.json').size()
+    assert stages['to_json']['rows_out'] == 9
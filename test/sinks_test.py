@@ -0,0 +1,23 @@
+import json
+from petl.util.base import Table
+import fhir_petl.sinks as sinks
+
+class CountingTable(Table):
+    def __init__(self, rows):
+        self.rows = rows
+        self.iterations = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        return iter(self.rows)
+
+def test_tee(tmpdir):
+    table = CountingTable([('id', 'status', 'note'), ('1', 'final', 'a'), ('2', 'final', None)])
+    target = str(tmpdir.join('Observation.json'))
+    summary = sinks.tee(table, 'Observation', [sinks.NDJSONSink(target), sinks.StatsSink()])
+    assert table.iterations == 1
+    assert summary['resources'] == 2
+    assert summary['sinks'][0]['resources'] == 2
+    assert summary['sinks'][1]['elements'] == {'id': 2, 'resourceType': 2, 'note': 1, 'status': 2}
+    with open(target) as f:
+        assert [json.loads(line)['id'] for line in f] == ['1', '2']
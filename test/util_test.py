@@ -1,4 +1,6 @@
+from datetime import datetime
 import fhir_petl.util as util
+import pytest
 import petl as etl
 
 def test_dateparser():
@@ -7,6 +9,26 @@ def test_dateparser():
     second = util.dateparser('%Y', util.ISOFormat.SECOND)
     assert second('1994').isoformat() == '1994-01-01T00:00:00'
 
+@pytest.mark.parametrize('format, text', [
+    ('%m/%d/%Y', '01/02/1994'), ('%m/%d/%Y', '1/2/1994'), ('%Y-%m-%d %H:%M:%S', '1994-01-02 03:04:05'),
+    ('%Y-%m-%d %H:%M:%S', '1994-01-02  03:04:05'), ('%d-%m-%y', '02-01-94'), ('%d-%m-%y', '02-01-68'), ('%b %Y', 'Jan 1994'),
+    ('%m/%d/%Y', '02/30/1994'), ('%m/%d/%Y', '13/01/1994'), ('%Y', '0000'), ('%Y', 'x994'), ('%Y', 1994)])
+def test_compile_strptime(format, text):
+    def parse(parser):
+        try:
+            return parser(text)
+        except (TypeError, ValueError) as e:
+            return type(e), str(e)
+    assert parse(util.compile_strptime(format)) == parse(lambda text: datetime.strptime(text, format))
+
+def test_dateparser_cache():
+    parse = util.dateparser('%m/%d/%Y', util.ISOFormat.DAY)
+    assert parse('01/02/1994') is parse('01/02/1994')
+    assert parse('01/02/1994').isoformat() == '1994-01-02'
+    assert parse('') is None
+    with pytest.raises(ValueError):
+        parse('01/32/1994')
+
 def test_join():
     assert util.join() == ''
     assert util.join(1, 2, 3) == '1 2 3'
@@ -19,4 +41,79 @@ def test_preprocess():
 
     table = util.preprocess(table, 'SUBJECT')
     result = list(table.data())
-    assert result == [(1, 'Bob', result[0][2]), (2, 'Steve', result[1][2])]
\ No newline at end of file
+    assert result == [(1, 'Bob', result[0][2]), (2, 'Steve', result[1][2])]
+
+def test_chunks():
+    assert list(util.chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.chunks([], 2)) == []
+
+def test_preprocess_key():
+    table = etl.fromcolumns([['1', '2', '1'], ['a', 'a', 'b']], ['SID', 'CODE'])
+    first = list(util.preprocess(table, ids=['ID', 'OTHER'], key=['SID', 'CODE']).data())
+    again = list(util.preprocess(table, ids=['ID', 'OTHER'], key=['SID', 'CODE']).data())
+    assert first == again
+    assert len({row[2] for row in first} | {row[3] for row in first}) == 6
+    other = list(util.preprocess(table, ids=['ID'], key=['SID', 'CODE'], namespace='site-b').data())
+    assert other[0][2] != first[0][2]
+    with pytest.raises(ValueError):
+        list(util.preprocess(table, key='SID'))
+
+def test_preprocess_key_collisions(monkeypatch):
+    monkeypatch.setattr(util, 'DIGEST', 0)
+    table = etl.fromcolumns([[str(i) for i in range(1000)]], ['SID'])
+    assert len(list(util.preprocess(table, key='SID').data())) == 1000
+    with pytest.raises(ValueError):
+        list(util.preprocess(etl.fromcolumns([['1', '2', '1']], ['SID']), key='SID'))
+
+def test_preprocess_key_duplicate_before_output(tmpdir):
+    table = etl.fromcolumns([['1', '2', '1']], ['SID'])
+    rows = iter(util.preprocess(table, key='SID'))
+    with pytest.raises(ValueError):
+        next(rows)
+    target = tmpdir.join('out.csv')
+    with pytest.raises(ValueError):
+        util.preprocess(table, key='SID').tocsv(str(target))
+    assert not target.exists() or target.read() == ''
+
+def test_shiftdates():
+    index_date = util.dateparser('%Y', util.ISOFormat.DAY)('1994')
+    table = etl.wrap([['ID', 'index_date', 'DAYS', 'MORE'], ['1', index_date, '31', 1], ['2', index_date, '', 1],
+                      ['3', None, '1', 1], ['4', datetime(1994, 3, 1, 12), -1, 0.5]])
+    result = list(table.shiftdates('date', 'index_date', ['DAYS', 'MORE'], batch=2).cut('ID', 'date'))
+    assert result == [('ID', 'date'), ('1', '1994-02-02'), ('2', None), ('3', None), ('4', '1994-03-01')]
+    assert result[1][1].isoformat() == '1994-02-02'
+    births = etl.wrap([['sample_date', 'age'], ['2000-06-15', '10']])
+    assert list(births.shiftdates('birth', 'sample_date', 'age', util.ISOFormat.YEAR, scale=-365.25).values('birth')) == ['1990']
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_externalsort(tmpdir, workers):
+    rows = [(i % 7, i) for i in range(500)]
+    table = etl.wrap([('KEY', 'N')] + rows).externalsort('KEY', memory=2000, tempdir=str(tmpdir), workers=workers, fanin=3)
+    assert list(table.data()) == sorted(rows, key=lambda row: row[0])
+    assert tmpdir.listdir() == []
+    assert list(etl.wrap([('KEY', 'N')] + rows).externalsort('KEY').data()) == sorted(rows, key=lambda row: row[0])
+
+@pytest.mark.parametrize('memory', [2 ** 30, 200])
+def test_externalsort_mixed(memory):
+    table = etl.wrap([('KEY', 'N')] + [(['2', None, 1, 'a', b'b', 2.5][i % 6], i) for i in range(60)])
+    assert list(map(tuple, table.externalsort('KEY', memory=memory))) == list(table.sort('KEY'))
+    blank = etl.fromcolumns([['2', '', '1'], ['a', 'b', 'c']], ['SUBJECT', 'NAME'])
+    assert list(util.preprocess(blank, 'SUBJECT', memory=memory).values('NAME')) == ['b', 'c', 'a']
+
+@pytest.mark.parametrize('value', ['1', ' -2 ', '1_000', '2.5', '1e3', 'nan', '-inf', '2j', 'x', '', '1.', 2.5, None, True])
+def test_number(value):
+    expected = etl.numparser()(value)
+    assert type(util.number(value)) is type(expected)
+    assert repr(util.number(value)) == repr(expected)
+
+def test_numbers():
+    nulls = ['', '-9', '#VALUE!']
+    assert util.numbertype(['1', '', '2'], nulls) is int
+    assert util.numbertype(['1', '2.5'], nulls) is float
+    assert util.numbertype(['1', 'x'], nulls) is None
+    assert util.numbers(['1', '', '-9', '#VALUE!', '2'], nulls) == [1, None, None, None, 2]
+    assert util.numbers(['1', '2', 'x', '2.5'], sample=2) == [1, 2, 'x', 2.5]
+    assert util.numbers(['1', '#N/A', '', '2.5']) == [1, None, None, 2.5]
+    assert util.numbers(['1', '', '2'], nulls=()) == [1, '', 2]
+    table = etl.wrap([['ID', 'VALUE'], ['a', '1'], ['b', '-9'], ['c', '2.5']]).convertnumbers('VALUE', nulls=nulls, batch=2)
+    assert list(table.values('VALUE')) == [1, None, 2.5]
@@ -0,0 +1,43 @@
+import petl as etl
+import fhir_petl.fhir as fhir
+from fhir_petl.validate import Validator
+
+def test_validator():
+    validator = Validator('Patient', sample=1)
+    validator.check([
+        {'id': '1', 'resourceType': 'Patient', 'gender': 'female', 'birthDate': '1990-01-02'},
+        {'id': '2', 'resourceType': 'Patient', 'marital_status': {'coding': [{'code': 'M'}]}, 'birthDate': '1990-01-02T10:00'},
+    ])
+    report = validator.report()
+    assert report['resources'] == 2
+    assert report['invalid'] == 1
+    assert report['errors'] == {'Patient.marital_status: is not an element': 1,
+                                'Patient.birthDate: not a date (YYYY, YYYY-MM or YYYY-MM-DD)': 1}
+    assert report['samples'] == [{'id': '2', 'rule': 'Patient.marital_status: is not an element'}]
+
+def test_validator_quantity():
+    validator = Validator('Observation')
+    validator.check([{'id': '1', 'resourceType': 'Observation', 'status': 'final', 'code': {'coding': [{'code': 'x'}]},
+                      'valueQuantity': {'unit': 'mg'}}])
+    assert validator.errors == {'Observation.valueQuantity: Quantity.value is missing': 1}
+
+def test_to_json_validator(tmpdir):
+    table = etl.wrap([['id', 'status', 'code']] + [[str(i), 'final', ('http://loinc.org', '1234-5')] for i in range(5)]
+                     + [['bad id', 'done', None]])
+    validator = Validator('Observation')
+    fhir.to_json(table, 'Observation', str(tmpdir.join('Observation.json')), validator=validator, workers=2, chunksize=2)
+    assert validator.resources == 6
+    assert validator.invalid == 1
+    assert sorted(validator.errors) == ['Observation.code: is missing', 'Observation.id: not a valid id',
+                                        'Observation.status: not one of amended, cancelled, corrected, entered-in-error, '
+                                        'final, preliminary, registered, unknown']
+
+def test_validator_rate():
+    validator = Validator('Patient', rate=0.5)
+    resources = [{'id': str(i), 'resourceType': 'Patient', 'gender': 'x'} for i in range(5)]
+    validator.check(resources[:3])
+    validator.check(resources[3:])
+    report = validator.report()
+    assert report['resources'] == 5
+    assert report['checked'] == 3
+    assert [s['id'] for s in report['samples']] == ['0', '2', '4']